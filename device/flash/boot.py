@@ -8,6 +8,8 @@
 #
 # SPDX-License-Identifier:    BSD-3-Clause
 
+import boottrace
 import expansionboard
 expansionboard.enable_console_on_serial()
+boottrace.mark('boot.py')
 
@@ -0,0 +1,57 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+#
+# (C) 2016 Chris Liechti <cliechti@gmx.net>
+#
+# SPDX-License-Identifier:    BSD-3-Clause
+"""\
+Optional profiling of the boot process.
+
+The duration and the free heap after each stage are recorded and sent as ulog
+message, so that they can be collected with "logviewer.py --boot-report".
+Tracing is enabled when the file /flash/boottrace exists (see
+"wipy-ftp.py config-boottrace").
+"""
+import gc
+import os
+import time
+
+try:
+    os.stat('/flash/boottrace')
+    enabled = True
+except OSError:
+    enabled = False
+
+_t_last = time.ticks_ms()
+# the first stage is the time from reset until this module is imported
+_stages = [('firmware', _t_last, gc.mem_free())] if enabled else []
+_reported = False
+
+
+def mark(stage):
+    """Record the end of a boot stage"""
+    global _t_last
+    if enabled:
+        t_now = time.ticks_ms()
+        _stages.append((stage, time.ticks_diff(t_now, _t_last), gc.mem_free()))
+        _t_last = time.ticks_ms()
+
+
+def report():
+    """\
+    Send the stages recorded since the last report as one ulog message:
+    "trace [reset=<cause>] <stage>=<ms>/<free bytes> ..."
+    """
+    global _reported
+    if not enabled or not _stages:
+        return
+    import ulog
+    import machine
+    parts = ['trace']
+    if not _reported:
+        parts.append('reset={}'.format(machine.reset_cause()))
+        _reported = True
+    for stage, duration, free in _stages:
+        parts.append('{}={}/{}'.format(stage, duration, free))
+    del _stages[:]
+    ulog.Logger('BOOT: ').notice(' '.join(parts))
@@ -52,7 +52,11 @@ def enable_console_on_serial():
 
 
 def set_callback_for_switch(callback):
-    """Set a function to be run when the button is pressed"""
+    """\
+    Set a function to be run when the button is pressed. It is called in
+    interrupt context, to wake up a task of a scheduler.Scheduler, use
+    the function returned by its irq_handler(flag) method as callback.
+    """
     if callback is not None:
         s1.irq(trigger=Pin.IRQ_FALLING, priority=1, handler=callback)
     else:
@@ -6,22 +6,155 @@
 # SPDX-License-Identifier:    BSD-3-Clause
 """\
 A simple scheduler based on generators.
+
+Tasks yield to let others run. What they yield determines when they run
+again:
+
+- nothing (None, 0): as soon as possible
+- a flag mask (int): when one of the flags is set, see set_flag()
+- a Delay object: when the time is up (or one of its flags is set)
+- a Readable or Writable object: when the stream is ready (or on timeout)
+
+Runnable tasks with a higher priority are served first, lower ones only
+run when all of the higher ones are waiting. The time used by each step
+of a task is measured, steps longer than the budget are reported. See
+Scheduler.stats() for an overview.
 """
+import array
 import gc
 import sys
 import time
+try:
+    import uheapq as heapq
+except ImportError:
+    import heapq
+try:
+    import uselect as select
+except ImportError:
+    import select
+try:
+    from machine import idle
+except ImportError:
+    idle = lambda: time.sleep(0.001)
+try:
+    from micropython import schedule
+except ImportError:
+    schedule = None
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_us = time.ticks_us
+    ticks_add = time.ticks_add
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    # CPython, e.g. for tests
+    ticks_ms = lambda: int(time.monotonic() * 1000)
+    ticks_us = lambda: int(time.monotonic() * 1000000)
+    ticks_add = lambda a, b: a + b
+    ticks_diff = lambda a, b: a - b
+
+# the clock of the scheduler is moved back before it leaves the small int range
+CLOCK_LIMIT = 1 << 29
+
+# number of flags that can have interrupt handlers (the lowest bits)
+IRQ_FLAGS = 32
+
+# while tasks wait for streams, sleep() is called with at most this timeout,
+# so that the loop can poll them; while tasks are runnable, streams are
+# checked at this interval.
+POLL_MS = 10
+
+
+def _poll_key(obj):
+    # poll() returns objects on MicroPython and file descriptors on CPython
+    try:
+        return obj.fileno()
+    except AttributeError:
+        return obj
 
 
 class ExitScheduler(Exception):
     pass
 
 
+class BudgetExceeded(Exception):
+    """Passed to Task.handle_exception when a step took too long, the task keeps running"""
+    pass
+
+
+class Delay(object):
+    """\
+    Yield this from a task to wait ms milliseconds, or until one of the
+    flags in mask is set, whatever comes first. With periodic, the time is
+    counted from the previous deadline of the task instead of now, so that
+    the period does not drift. The object can be yielded again and again.
+    """
+    def __init__(self, ms, mask=0, periodic=False):
+        self.ms = ms
+        self.mask = mask
+        self.periodic = periodic
+
+    def _suspend(self, scheduler, task):
+        now = scheduler.clock()
+        if self.periodic and task.deadline is not None:
+            deadline = task.deadline + self.ms
+            if deadline < now:
+                deadline = now  # too late, do not try to catch up
+        else:
+            deadline = now + self.ms
+        scheduler._wait(task, self.mask, deadline)
+
+
+class Readable(object):
+    """\
+    Yield this from a task to wait until the stream (e.g. a non-blocking
+    socket) can be read, or timeout ms have passed (None: no timeout).
+    Afterwards, events holds the poll events, 0 on timeout. The object can
+    be yielded again and again, but only one task can wait for a stream.
+    """
+    event = select.POLLIN
+
+    def __init__(self, stream, timeout=None):
+        self.stream = stream
+        self.timeout = timeout
+        self.events = 0
+
+    def _suspend(self, scheduler, task):
+        self.events = 0
+        scheduler._wait_io(task, self)
+
+
+class Writable(Readable):
+    """\
+    Yield this from a task to wait until the stream can be written, or
+    timeout ms have passed (None: no timeout).
+    """
+    event = select.POLLOUT
+
+
 class Task(object):
-    def __init__(self, scheduler, generator):
+    budget = None   # us per step, overrides Scheduler.step_budget
+
+    def __init__(self, scheduler, generator, priority=0):
         self.scheduler = scheduler
         self.generator = generator
         self.iterator = generator()
+        self.priority = priority
+        self.name = getattr(generator, '__name__', '?')
+        self.wake = 'start'     # why it was resumed last: start, flag, timer or io
+        # runs, cpu_ms and overruns are halved when they pass CLOCK_LIMIT,
+        # so that they stay small ints (and their ratios are kept)
+        self.runs = 0           # number of steps
+        self.cpu_ms = 0         # total time spent in steps
+        self._cpu_us = 0        # ... the remainder below 1 ms
+        self.max_us = 0         # longest step
+        self.overruns = 0       # steps longer than the budget
         self.mask = 0
+        self.deadline = None    # of the last timed wait, in scheduler.clock() time
+        self._timer = 0         # id of the pending timer, 0 if none
+        self._io = None         # Readable or Writable the task waits for
+        self._list = None       # scheduler.running, scheduler.waiting or None
+        self._index = 0         # position in that list
 
     def stop(self):
         self.scheduler.remove(self)
@@ -29,7 +162,8 @@ class Task(object):
     def restart(self):
         self.scheduler.remove(self)
         self.iterator = self.generator()
-        self.scheduler.running.append(self)
+        self.wake = 'start'
+        self.scheduler._append(self.scheduler._runnable(self.priority), self)
 
     # this function is called by the scheduler
     def _abort_on_error(self, exception):
@@ -49,78 +183,479 @@ class RestartingTask(Task):
 
 
 class Scheduler(object):
-    def __init__(self):
+    """\
+    The order of the tasks in running and waiting is not preserved, tasks
+    are moved between them in constant time (see _append/_discard).
+    Waiting tasks are also registered per flag bit in waiters, so setting a
+    flag only looks at the tasks waiting for it.
+
+    There is a list of runnable tasks per priority in levels, running is
+    the one of priority 0. step_budget is in microseconds (None: no limit).
+
+    Streams that tasks wait for are registered in a poller, that is checked
+    on each pass and that sleep() blocks in while no task is runnable.
+
+    set_flag() must not be called from interrupt handlers, use the
+    functions returned by irq_handler() instead.
+    """
+    def __init__(self, step_budget=None):
         self.running = []
+        self.levels = [(0, self.running)]   # (priority, runnable tasks), highest first
+        self.step_budget = step_budget
         self.waiting = []
+        self.waiters = []   # per flag bit: set of tasks waiting for it
+        self._bits = {}     # flag -> bit number
+        self._spare = set() # swapped with a set of waiters while it is processed
         self.flags = 0
         self.flag_counter = 0
+        self.timers = []    # heap of (deadline, timer id, task), entries of woken tasks are removed lazily
+        self._timer_id = 0
+        self._stale = 0     # number of entries in timers of tasks woken otherwise
+        self.sleep_timeout = None   # for sleep(): ms until the next timer expires
+        self.now = 0
+        self._ticks = ticks_ms()
+        self._wake = False
+        self.poller = None  # select.poll(), created for the first I/O wait
+        self._poll = None   # its ipoll() (no result list is allocated) or poll()
+        self._polled = 0    # ticks_ms() of the last poll
+        self._collected = False # gc.collect() ran since the last task step
+        self.io = {}        # poll key -> task, for tasks waiting on streams
+        # per flag bit: number of interrupts (only written by the handlers),
+        # the number seen by the loop and by take_events() (16 bits, wrapping)
+        self._irq_counts = array.array('H', [0] * IRQ_FLAGS)
+        self._irq_flagged = array.array('H', [0] * IRQ_FLAGS)
+        self._irq_taken = array.array('H', [0] * IRQ_FLAGS)
+        self._irq_bits = []     # flag bits that have handlers
+        self._irq_pending = array.array('B', [0])
+        self._irq_wakeup = None # for micropython.schedule
+        # the window of these counters restarts automatically before they
+        # leave the small int range
+        self.passes = 0         # loop iterations
+        self.idle_ms = 0        # time spent in sleep()
+        self._idle_us = 0       # ... the remainder below 1 ms
+        self._stats_start = 0   # clock() when passes and idle_ms were reset
+
+    def tasks(self):
+        """Return a list of all tasks, runnable and waiting"""
+        tasks = list(self.waiting)
+        for priority, running in self.levels:
+            tasks.extend(running)
+        return tasks
 
     def clear(self):
-        del self.running[:]
+        for task in self.tasks():
+            if task._io is not None:
+                self._unregister(task)
+            task._list = None
+        for priority, running in self.levels:
+            del running[:]
         del self.waiting[:]
+        for tasks in self.waiters:
+            tasks.clear()
+        del self.timers[:]
+        self._stale = 0
+
+    def clock(self):
+        """Return milliseconds since the start, this clock does not wrap around"""
+        t = ticks_ms()
+        self.now += ticks_diff(t, self._ticks)
+        self._ticks = t
+        if self.now > CLOCK_LIMIT:
+            self._rebase()
+        return self.now
+
+    def _rebase(self):
+        offset = self.now
+        self.now = 0
+        self._stats_start -= offset
+        for task in self.tasks():
+            if task.deadline is not None:
+                task.deadline -= offset
+        # same order, so it is still a heap
+        self.timers = [(deadline - offset, timer_id, task) for deadline, timer_id, task in self.timers]
 
     def new_flag(self):
         flag = 1 << self.flag_counter
         self.flag_counter += 1
+        self._waiters_for(flag)
         return flag
 
-    def run(self, generator, cls=Task):
+    def _waiters_for(self, flag):
+        """return the set of waiters for a single bit flag"""
+        bit = self._bits.get(flag)
+        if bit is None:
+            bit = 0
+            while flag >> bit > 1:
+                bit += 1
+            self._bits[flag] = bit
+            while len(self.waiters) <= bit:
+                self.waiters.append(set())
+        return self.waiters[bit]
+
+    def run(self, generator, cls=Task, priority=0):
+        # Task subclasses may not know the priority argument
         task = cls(self, generator)
-        self.running.append(task)
+        task.priority = priority
+        self._append(self._runnable(priority), task)
         self.wakeup()
         return task
 
+    def _runnable(self, priority):
+        """return the list of runnable tasks for priority"""
+        for p, running in self.levels:
+            if p == priority:
+                return running
+        running = []
+        self.levels.append((priority, running))
+        self.levels.sort(key=lambda level: -level[0])
+        return running
+
+    def _append(self, tasks, task):
+        task._list = tasks
+        task._index = len(tasks)
+        tasks.append(task)
+
+    def _discard(self, task):
+        """remove task from its list, the last one takes its place"""
+        tasks = task._list
+        last = tasks.pop()
+        if last is not task:
+            tasks[task._index] = last
+            last._index = task._index
+        task._list = None
+
+    def _unregister(self, task):
+        """remove a waiting task from the sets of the flags and the poller"""
+        if task._io is not None:
+            self.poller.unregister(task._io.stream)
+            del self.io[_poll_key(task._io.stream)]
+            task._io = None
+        mask = task.mask
+        while mask:
+            flag = mask & -mask     # lowest bit set
+            self.waiters[self._bits[flag]].discard(task)
+            mask ^= flag
+
     def remove(self, task):
-        try:
-            self.running.remove(task)
-        except ValueError:
-            pass
-        try:
-            self.waiting.remove(task)
-        except ValueError:
-            pass
+        self._cancel_timer(task)
+        if task._list is self.waiting:
+            self._unregister(task)
+        if task._list is not None:
+            self._discard(task)
 
     def set_flag(self, flag):
         self.flags |= flag
         self.wakeup()
 
+    def irq_handler(self, flag):
+        """\
+        Return a function, to be used as interrupt handler, that sets the
+        flag. It does not allocate memory, so that it can be used for hard
+        interrupts. Interrupts are counted, see take_events(). wakeup() is
+        called via micropython.schedule() where available.
+        """
+        self._waiters_for(flag)
+        bit = self._bits[flag]
+        if bit >= IRQ_FLAGS:
+            raise ValueError('only the first {} flags can have interrupt handlers'.format(IRQ_FLAGS))
+        if bit not in self._irq_bits:
+            self._irq_bits.append(bit)
+        if self._irq_wakeup is None:
+            self._irq_wakeup = lambda argument: self.wakeup()
+        counts = self._irq_counts
+        pending = self._irq_pending
+        wakeup = self._irq_wakeup
+
+        def handler(argument=None):
+            counts[bit] = (counts[bit] + 1) & 0xffff
+            pending[0] = 1
+            self._wake = True   # enough for the default sleep()
+            if schedule is not None:
+                try:
+                    schedule(wakeup, None)
+                except RuntimeError:
+                    pass    # queue full, a wakeup is already pending
+        return handler
+
+    def take_events(self, flag):
+        """Return the number of interrupts for flag since the last call"""
+        bit = self._bits[flag]
+        count = self._irq_counts[bit]
+        events = (count - self._irq_taken[bit]) & 0xffff
+        self._irq_taken[bit] = count
+        return events
+
+    def _run_irqs(self):
+        # cleared first, so that interrupts meanwhile are seen on the next pass
+        self._irq_pending[0] = 0
+        counts = self._irq_counts
+        flagged = self._irq_flagged
+        for bit in self._irq_bits:
+            count = counts[bit]
+            if count != flagged[bit]:
+                flagged[bit] = count
+                self.flags |= 1 << bit
+
+    def _wait(self, task, mask, deadline=None):
+        """move a running task to the waiting list"""
+        self._discard(task)
+        self._append(self.waiting, task)
+        task.mask = mask
+        while mask:
+            flag = mask & -mask     # lowest bit set
+            self._waiters_for(flag).add(task)
+            mask ^= flag
+        if deadline is not None:
+            self._timer_id = (self._timer_id + 1) & 0x3fffffff or 1
+            task.deadline = deadline
+            task._timer = self._timer_id
+            heapq.heappush(self.timers, (deadline, self._timer_id, task))
+
+    def _wait_io(self, task, wait):
+        """move a running task to the waiting list, until the stream is ready"""
+        if self.poller is None:
+            self.poller = select.poll()
+            self._poll = getattr(self.poller, 'ipoll', self.poller.poll)
+        self.poller.register(wait.stream, wait.event)
+        self.io[_poll_key(wait.stream)] = task
+        deadline = None if wait.timeout is None else self.clock() + wait.timeout
+        self._wait(task, 0, deadline)
+        task._io = wait
+
+    def _run_io(self, timeout=0):
+        """resume tasks whose streams are ready, wait up to timeout ms for them"""
+        ready = 0
+        for entry in self._poll(timeout):
+            task = self.io.get(_poll_key(entry[0]))
+            if task is not None:
+                task._io.events = entry[1]
+                task.wake = 'io'
+                self._resume(task)
+                ready += 1
+        self._polled = ticks_ms()
+        return ready
+
+    def _cancel_timer(self, task):
+        """the entry of the task in timers becomes stale, they are removed when too many"""
+        if task._timer:
+            task._timer = 0
+            self._stale += 1
+            if self._stale > len(self.timers) // 2:
+                self.timers[:] = [entry for entry in self.timers if entry[2]._timer == entry[1]]
+                heapq.heapify(self.timers)
+                self._stale = 0
+
+    def _run_timers(self):
+        now = self.clock()
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            deadline, timer_id, task = heapq.heappop(timers)
+            if task._timer == timer_id:
+                task._timer = 0
+                task.wake = 'timer'
+                self._resume(task)
+            else:
+                self._stale -= 1
+
+    def _resume(self, task):
+        """move a waiting task to the running list"""
+        self._cancel_timer(task)
+        self._unregister(task)
+        self._discard(task)
+        self._append(self._runnable(task.priority), task)
+
+    def _run_flags(self):
+        flags = self.flags
+        self.flags = 0
+        while flags:
+            flag = flags & -flags   # lowest bit set
+            flags ^= flag
+            bit = self._bits.get(flag)
+            if bit is not None and self.waiters[bit]:
+                # the set is replaced while it is processed, as resumed tasks
+                # are removed from the sets of all their flags
+                tasks = self.waiters[bit]
+                self.waiters[bit] = self._spare
+                for task in tasks:
+                    task.wake = 'flag'
+                    self._resume(task)
+                tasks.clear()
+                self._spare = tasks
+
+    def next_timeout(self):
+        """Return milliseconds until the next timer expires, None if there is none"""
+        timers = self.timers
+        while timers and timers[0][2]._timer != timers[0][1]:
+            heapq.heappop(timers)
+            self._stale -= 1
+        if not timers:
+            return None
+        return max(0, timers[0][0] - self.clock())
+
     def loop(self):
+        levels = self.levels
         while True:
+            self.passes += 1
+            if self.passes > CLOCK_LIMIT:
+                self._reset_stats()
+            if self._irq_pending[0]:
+                self._run_irqs()
             if self.flags:
-                for task in list(self.waiting):
-                    if self.flags & task.mask:
-                        self.running.append(task)
-                        self.waiting.remove(task)
-                self.flags = 0
-            if self.running:
-                for task in list(self.running):
-                    try:
-                        mask = task.iterator.__next__()
-                    except StopIteration:
-                        self.remove(task)
-                    except ExitScheduler:
-                        raise
-                    except:
-                        # other errors: remove task, handle exception
-                        self.remove(task)
-                        task._abort_on_error(sys.exc_info()[1])
-                    else:
-                        if mask:
-                            self.running.remove(task)
-                            self.waiting.append(task)
-                            task.mask = mask
+                self._run_flags()
+            if self.timers:
+                self._run_timers()
+            if self.io and ticks_diff(ticks_ms(), self._polled) >= POLL_MS:
+                self._run_io()
+            # one pass over the runnable tasks of the highest priority, then
+            # check again, as flags and timers may have resumed others
+            for priority, running in levels:
+                if running:
+                    self._run_tasks(running)
+                    self._collected = False
+                    break
             else:
+                if self.io and self._run_io():
+                    continue
+                t_start = ticks_us()
+                timeout = self.next_timeout()
+                if self.io and (timeout is None or timeout > POLL_MS):
+                    # sleep() returns early, so the streams are polled again
+                    timeout = POLL_MS
+                self.sleep_timeout = timeout
                 self.sleep()
+                us = self._idle_us + ticks_diff(ticks_us(), t_start)
+                if us >= 1000:
+                    self.idle_ms += us // 1000
+                    us %= 1000
+                    if self.idle_ms > CLOCK_LIMIT:
+                        self._reset_stats()
+                self._idle_us = us
+
+    def _run_tasks(self, running):
+        # tasks that leave the list are replaced by the last one, so
+        # the index only advances if the task is still in its place
+        i = 0
+        while i < len(running):
+            task = running[i]
+            t_start = ticks_us()
+            try:
+                mask = task.iterator.__next__()
+            except StopIteration:
+                mask = StopIteration
+            except ExitScheduler:
+                raise
+            except:
+                mask = sys.exc_info()[1]
+            duration = ticks_diff(ticks_us(), t_start)
+            task.runs += 1
+            us = task._cpu_us + duration
+            if us >= 1000:
+                task.cpu_ms += us // 1000
+                us %= 1000
+            task._cpu_us = us
+            if task.runs > CLOCK_LIMIT or task.cpu_ms > CLOCK_LIMIT:
+                task.runs >>= 1
+                task.cpu_ms >>= 1
+                task.overruns >>= 1
+            if duration > task.max_us:
+                task.max_us = duration
+            budget = task.budget or self.step_budget
+            if budget and duration > budget:
+                task.overruns += 1
+                task.handle_exception(BudgetExceeded(
+                    'step took {} us, budget is {} us'.format(duration, budget)))
+            if mask:
+                if type(mask) is int:
+                    self._wait(task, mask)
+                elif mask is StopIteration:
+                    self.remove(task)
+                elif isinstance(mask, BaseException):
+                    # other errors: remove task, handle exception
+                    self.remove(task)
+                    task._abort_on_error(mask)
+                else:
+                    mask._suspend(self, task)
+            if i < len(running) and running[i] is task:
+                i += 1
+
+    def stats(self, reset=False):
+        """\
+        Return a dict with the loop rate and the fraction of the time spent
+        sleeping since the last reset (done automatically when the counters
+        get too large, see elapsed_ms) and a list of dicts for the tasks
+        (their counters are not reset).
+        """
+        elapsed = self.clock() - self._stats_start
+        tasks = []
+        for task in self.tasks():
+            tasks.append({
+                'name': task.name,
+                'priority': task.priority,
+                'state': 'waiting' if task._list is self.waiting else 'running',
+                'mask': task.mask,
+                'io': task._io is not None,
+                'runs': task.runs,
+                'cpu_ms': task.cpu_ms,
+                'max_us': task.max_us,
+                'overruns': task.overruns,
+                'wake': task.wake,
+            })
+        stats = {
+            'elapsed_ms': elapsed,
+            'passes': self.passes,
+            'passes_per_s': self.passes * 1000 // elapsed if elapsed else 0,
+            'idle': self.idle_ms / elapsed if elapsed else 0,
+            'tasks': tasks,
+        }
+        if reset:
+            self._reset_stats()
+        return stats
+
+    def _reset_stats(self):
+        self.passes = 0
+        self.idle_ms = 0
+        self._idle_us = 0
+        self._stats_start = self.clock()
+
+    def log_stats(self, log, reset=False):
+        """Write the stats to a ulog.Logger, one line per task"""
+        stats = self.stats(reset)
+        log.info('{passes_per_s} passes/s, idle {idle:.0%} in {elapsed_ms} ms'.format(**stats))
+        for task in stats['tasks']:
+            log.info('{name} prio {priority} {state} mask {mask:#x}: {runs} runs, '
+                     '{cpu_ms} ms, max {max_us} us, {overruns} overruns, wake {wake}'.format(**task))
 
     # can be customized by subclassing
     # sleep can be blocking while saving power for example, but the wakeup
     # call must exit it
 
     def wakeup(self):
-        pass
+        self._wake = True
 
     def sleep(self):
-        # XXX use low power features, e.g. machine.idle()
-        time.sleep_ms(10)
-        gc.collect()
+        """\
+        Called when no task is running. Block until wakeup() is called or
+        sleep_timeout milliseconds have passed (None: no timer is pending).
+        This version also returns as soon as a stream that a task waits for
+        is ready.
+        """
+        if not self._collected:
+            gc.collect()
+            self._collected = True
+        timeout = self.sleep_timeout
+        if timeout is not None:
+            deadline = ticks_add(ticks_ms(), timeout)
+        while not self._wake:
+            if timeout is None:
+                remaining = POLL_MS
+            else:
+                remaining = ticks_diff(deadline, ticks_ms())
+                if remaining <= 0:
+                    break
+            if self.io:
+                if self._run_io(min(remaining, POLL_MS)):
+                    break
+            else:
+                idle()
+        self._wake = False
 
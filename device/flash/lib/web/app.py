@@ -12,42 +12,168 @@ except ImportError:
 
 from .response import STATUS404
 
+# characters that make a path segment a regexp ('.' is treated as literal)
+REGEXP_CHARS = '()[]{}*+?|\\^$'
 
-class App(object):
+
+def _to_int(segment):
+    if segment.isdigit():
+        return int(segment)
+    return None
+
+
+def _to_str(segment):
+    if segment:
+        return segment
+    return None
+
+
+# converters for typed path parameters, e.g. '/item/<int:number>', '<name>' is a str
+# ('<path:name>' matches the rest of the path, it is handled as regexp)
+CONVERTERS = {
+    'int': _to_int,
+    'str': _to_str,
+}
+
+
+def _count_groups(pattern):
+    return pattern.count('(') - pattern.count('\\(') - pattern.count('(?')
+
+
+class _Node(object):
+    """One level of the prefix tree, corresponds to one path segment"""
     def __init__(self):
-        self.routes = {}
+        self.children = {}  # static segment -> _Node
+        self.params = []    # (converter, _Node) for typed parameters
+        self.handlers = {}  # method -> function
+        self.regexps = []   # (method, regexp, number of groups, function), matching the rest of the path
+        self.mount = None   # App handling everything below this node
+
+
+class App(object):
+    def __init__(self, cache_bytes=4096):
+        self.root = _Node()
+        self.cache_bytes = cache_bytes
+        self.cache = None   # web.cache.ResponseCache, created for the first route with ttl
+        self.before = []    # functions called with (request) before it is handled
+        self.after = []     # functions called with (request, response, connection) after sending
 
     def handle_request(self, request, path):
-        for priority, _, regexp, function in self.routes[request.method]:
-            m = regexp.match(path)
-            # collect regexp groups to pass as args
-            if m is not None:
-                args = []
-                try:
-                    for i in range(1, 10):
-                        args.append(m.group(i))
-                except IndexError:
-                    pass
-                #~ print(args)
-                return function(request, *args)
-        else:
+        if not path:
+            path = '/'
+        result = self._match(self.root, request.method, path, 0, [])
+        if result is None:
             return STATUS404
+        function, args = result
+        return function(request, *args)
+
+    def _match(self, node, method, path, position, args):
+        # position is the index of the slash in front of the next segment
+        if position >= len(path):
+            function = node.handlers.get(method)
+            if function is not None:
+                return function, args
+        else:
+            end = path.find('/', position + 1)
+            if end < 0:
+                end = len(path)
+            segment = path[position + 1:end]
+            child = node.children.get(segment)
+            if child is not None:
+                result = self._match(child, method, path, end, args)
+                if result is not None:
+                    return result
+            for converter, child in node.params:
+                value = converter(segment)
+                if value is not None:
+                    args.append(value)
+                    result = self._match(child, method, path, end, args)
+                    if result is not None:
+                        return result
+                    args.pop()
+        if node.mount is not None:
+            args.append(path[position:])
+            return node.mount.handle_request, args
+        if node.regexps:
+            rest = path[position:]
+            for verb, regexp, groups, function in node.regexps:
+                if verb == method:
+                    m = regexp.match(rest)
+                    if m is not None:
+                        # collect regexp groups to pass as args
+                        for i in range(1, groups + 1):
+                            args.append(m.group(i))
+                        return function, args
+        return None
+
+    def _node(self, path):
+        """\
+        Walk (and create) the tree for the static and typed segments of the
+        path, return the node and the remaining (regexp) part of the path.
+        """
+        node = self.root
+        segments = path.split('/')[1:]
+        for n, segment in enumerate(segments):
+            if segment.startswith('<') and segment.endswith('>'):
+                kind = segment[1:-1].split(':')[0] if ':' in segment else 'str'
+                if kind == 'path':
+                    return node, '/'.join([''] + ['(.*)'] + segments[n + 1:])
+                converter = CONVERTERS[kind]
+                for c, child in node.params:
+                    if c is converter:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.params.append((converter, child))
+                    node = child
+            elif any(c in REGEXP_CHARS for c in segment):
+                return node, '/'.join([''] + segments[n:])
+            else:
+                node = node.children.setdefault(segment, _Node())
+        return node, None
 
     def optimize_routes(self):
-        # must sort handlers to get best matches first
-        for handlers in self.routes.values():
-            handlers.sort()
-            handlers.reverse()
-        #~ print(self.routes)
+        # no longer needed, kept for compatibility
+        pass
 
     def add_route(self, verb, path, function):
-        # default priority is number of slashes -> longer matches preferred
-        priority = path.count('/')
-        if not path.endswith('$'):
-            path = path + '$'
-        self.routes.setdefault(verb, []).append((priority, path, ure.compile(path), function))
+        if path.endswith('$'):
+            path = path[:-1]
+        node, pattern = self._node(path)
+        if pattern is None:
+            node.handlers[verb] = function
+        else:
+            node.regexps.append((verb, ure.compile(pattern + '$'), _count_groups(pattern), function))
         return function
 
-    # meant to be used as decorator
-    def route(self, path, method=b'GET'):
-        return lambda fn: self.add_route(method, path, fn)
+    def mount(self, path, app):
+        """Delegate all requests below path to an other App"""
+        node, pattern = self._node(path.rstrip('/'))
+        if pattern is not None:
+            raise ValueError('mount path must be static')
+        node.mount = app
+
+    # meant to be used as decorators
+    def before_request(self, fn):
+        self.before.append(fn)
+        return fn
+
+    def after_request(self, fn):
+        self.after.append(fn)
+        return fn
+
+    def route(self, path, method=b'GET', ttl=None):
+        """\
+        Register the decorated function for path. With ttl (seconds), its
+        SimpleResponse results are cached, per method and path.
+        """
+        def decorator(fn):
+            if ttl is None:
+                return self.add_route(method, path, fn)
+            if self.cache is None:
+                from .cache import ResponseCache
+                self.cache = ResponseCache(self.cache_bytes)
+            self.add_route(method, path, self.cache.cached(fn, ttl))
+            return fn
+        return decorator
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+#
+# (C) 2016 Chris Liechti <cliechti@gmx.net>
+#
+# SPDX-License-Identifier:    BSD-3-Clause
+"""\
+Cache for rendered responses, used by App.route(..., ttl=seconds).
+"""
+from .response import SimpleResponse, JsonResponse
+from .ticks import ticks_ms, ticks_add, ticks_diff
+
+# estimated memory used per entry, in addition to the content
+ENTRY_OVERHEAD = 64
+
+
+class ResponseCache(object):
+    """\
+    Cache of SimpleResponse objects (keyed by method and path), that expire
+    after a time to live. The total size of the cached contents is limited
+    to max_bytes, the least recently used entries are removed to make room.
+    """
+    def __init__(self, max_bytes=4096):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = {}   # key -> [expiry time, last use, size, response]
+        self._uses = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if ticks_diff(entry[0], ticks_ms()) > 0:
+                self.hits += 1
+                self._uses += 1
+                entry[1] = self._uses
+                return entry[3]
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, response, ttl):
+        """Store a response for ttl seconds, if it is a SimpleResponse that fits"""
+        if key in self.entries:
+            self._remove(key)
+        if not isinstance(response, SimpleResponse):
+            return
+        size = len(response.content) + len(key[1]) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        while self.size + size > self.max_bytes:
+            self._evict()
+        self._uses += 1
+        self.entries[key] = [ticks_add(ticks_ms(), int(ttl * 1000)), self._uses, size, response]
+        self.size += size
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def _evict(self):
+        # expired entries first, then the least recently used one
+        now = ticks_ms()
+        oldest = None
+        for key, entry in self.entries.items():
+            if ticks_diff(entry[0], now) <= 0:
+                oldest = key
+                break
+            if oldest is None or entry[1] < self.entries[oldest][1]:
+                oldest = key
+        self._remove(oldest)
+        self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def cached(self, function, ttl):
+        """Wrap a request handler, its responses are cached for ttl seconds"""
+        def handler(request, *args):
+            key = (request.method, request.path)
+            response = self.get(key)
+            if response is None:
+                response = function(request, *args)
+                self.put(key, response, ttl)
+            return response
+        return handler
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def add_stats_route(app, path='/_cache'):
+    """Serve the statistics of the cache of app as JSON"""
+    if app.cache is None:
+        # no routes with ttl (yet), serve the stats of an empty cache
+        app.cache = ResponseCache(app.cache_bytes)
+    app.add_route(b'GET', path, lambda request: JsonResponse(app.cache.stats()))
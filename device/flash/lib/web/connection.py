@@ -9,51 +9,191 @@ import gc
 from . import url
 from .response import STATUS204, STATUS500
 gc.collect()
-from .request import Request
+from .request import Request, RequestError
+from .ticks import ticks_us, ticks_diff
 gc.collect()
 
+# the head and small bodies are collected here and sent with one write,
+# shared by all connections as responses are sent one at a time
+HEAD_SIZE = 512
+_buffer = memoryview(bytearray(HEAD_SIZE))
+
+# unread bodies up to this size are dropped before a connection is closed,
+# closing with unread data makes the client see a reset instead of the response
+MAX_DRAIN = 512 * 1024
+
+
+class GCPolicy(object):
+    """\
+    Garbage collection before each request. Without min_free, it always
+    runs (the traditional behavior), otherwise only if less than min_free
+    bytes are free. Runs, skips and the time spent are counted so that the
+    effect of a setting can be measured (see web.stats).
+    """
+    def __init__(self, min_free=None):
+        self.min_free = min_free
+        self.runs = 0
+        self.skipped = 0
+        self.us = 0
+
+    def __call__(self):
+        if self.min_free is not None and gc.mem_free() >= self.min_free:
+            self.skipped += 1
+            return
+        t = ticks_us()
+        gc.collect()
+        self.us += ticks_diff(ticks_us(), t)
+        self.runs += 1
+
+
+# used by all connections, e.g. "web.connection.gc_policy.min_free = 8192"
+gc_policy = GCPolicy()
+
 
 class Connection(object):
-    def __init__(self, name, rfile, wfile, keep=False):
+    def __init__(self, name, rfile, wfile, keep=False, max_requests=20):
         self.name = name
         self.rfile = rfile
         self.wfile = wfile
+        self.keep_alive = keep  # server side permission for persistent connections
+        self.max_requests = max_requests
+        self.requests = 0
         self._keep = keep
+        self.http11 = True          # client supports HTTP/1.1 features, e.g. chunked encoding
+        self._position = 0          # bytes in the buffer
+        self.writes = 0             # number of writes to wfile, for statistics
+        self.response_writes = 0    # ... used for the last response
+        self.bytes_sent = 0
+        self.response_bytes = 0     # ... bytes of the last response
+        self._delimited = False     # the response has a body length, or no body
+
+    def write(self, data):
+        """Buffered write, small pieces are collected and sent together"""
+        n = len(data)
+        if self._position + n > HEAD_SIZE:
+            self._write_buffer()
+            if n > HEAD_SIZE // 2:
+                self.writes += 1
+                self.bytes_sent += n
+                self.wfile.write(data)
+                return
+        _buffer[self._position:self._position + n] = data
+        self._position += n
+
+    def _write_buffer(self):
+        if self._position:
+            self.writes += 1
+            self.bytes_sent += self._position
+            self.wfile.write(_buffer[:self._position])
+            self._position = 0
+
+    def flush(self):
+        self._write_buffer()
+        try:
+            self.wfile.flush()
+        except AttributeError:
+            pass
 
     def send_response(self, status):
-        self.wfile.write(b'HTTP/1.1 ')
-        self.wfile.write(status)
-        self.wfile.write(b'\r\n')
+        self._delimited = status[:3] in (b'204', b'304')
+        self.write(b'HTTP/1.1 ')
+        self.write(status)
+        self.write(b'\r\n')
 
     def send_header(self, key, value):
-        self.wfile.write(key)
-        self.wfile.write(b': ')
-        self.wfile.write(value)
-        self.wfile.write(b'\r\n')
+        if key in (b'Content-Length', b'Transfer-Encoding'):
+            self._delimited = True
+        self.write(key)
+        self.write(b': ')
+        self.write(value)
+        self.write(b'\r\n')
 
     def end_headers(self):
+        if not self._delimited:
+            # the client reads the body until the connection is closed
+            self._keep = False
         self.send_header(b'Server', b'femtoweb')
         self.send_header(b'Connection', b'keep-alive' if self._keep else b'close')
-        self.wfile.write(b'\r\n')
+        self.write(b'\r\n')
+
+    def send(self, response):
+        writes = self.writes
+        bytes_sent = self.bytes_sent
+        self._position = 0
+        if response.heads is None:
+            response.emit_head(self)
+        else:
+            # constant response, encode the head once per connection state
+            keep = self._keep
+            head = response.heads.get(keep)
+            if head is None:
+                response.emit_head(self)
+                if self.writes == writes and self._keep == keep:
+                    response.heads[keep] = bytes(_buffer[:self._position])
+            else:
+                self.write(head)
+        response.emit_content(self)
+        self.flush()
+        self.response_writes = self.writes - writes
+        self.response_bytes = self.bytes_sent - bytes_sent
+
+    def reject(self, response):
+        """Answer an invalid request, the rest of it is not read, so the connection is closed"""
+        self._keep = False
+        self.send(response)
 
     def do_request(self, app):
         request = Request(self)
-        while True:
-            gc.collect()
-            #~ print("ready")
-            try:
-                request._read_request()
-                response = app.handle_request(request, url.decode(request.path))
-                if response is None:
-                    response = STATUS204
-                request.cleanup()
-            except Exception as e:
-                sys.print_exception(e)
-                response = STATUS500
+        while self.handle_request(app, request):
+            pass
+
+    def handle_request(self, app, request):
+        """Read and answer one request, return True if the connection is kept open"""
+        gc_policy()
+        #~ print("ready")
+        try:
+            if not request._read_request():
+                return False
+        except OSError:
+            # idle timeout or connection reset while waiting for the request
+            return False
+        except RequestError as e:
+            self.reject(e.response)
+            return False
+        except Exception as e:
+            sys.print_exception(e)
+            self._keep = False
+            self.send(STATUS500)
+            return False
+        self.requests += 1
+        self.http11 = request.version != b'HTTP/1.0'
+        self._keep = self.keep_alive and request.keep_alive() and self.requests < self.max_requests
+        try:
+            # before hooks may answer the request themselves, e.g. for authentication
+            for hook in app.before:
+                response = hook(request)
+                if response is not None:
+                    break
+            else:
+                response = app.handle_request(request, url.decode(url.split(request.path)[0]))
+            if response is None:
+                response = STATUS204
+        except Exception as e:
+            sys.print_exception(e)
+            response = STATUS500
+            self._keep = False
+        self.send(response)
+        # after sending, streamed responses may read the body while they are generated
+        try:
+            if not request.cleanup(None if self._keep else MAX_DRAIN):
                 self._keep = False
-            response.emit(self)
-            for s in (self.name, b': ', request.method, b' ', request.path, b' -> ', response.status, b'\n'):
-                sys.stderr.buffer.write(s)
-            #~ gc.collect()
-            if not self._keep:
-                break
+        except OSError:
+            self._keep = False
+        for s in (self.name, b': ', request.method, b' ', request.path, b' -> ', response.status, b'\n'):
+            sys.stderr.buffer.write(s)
+        try:
+            for hook in app.after:
+                hook(request, response, self)
+        except Exception as e:
+            sys.print_exception(e)
+        return self._keep
@@ -5,6 +5,36 @@
 #
 # SPDX-License-Identifier:    BSD-3-Clause
 import json
+from . import url
+from .response import get_buffer, STATUS400, STATUS431
+
+MAX_LINE = 512      # limit for the request line and each header line
+MAX_HEADERS = 32    # limit for the number of header lines
+
+# headers stored in Request.headers: lowercase name -> name used as key
+_wanted = {}
+_wanted_lengths = set()
+
+
+def register_header(name):
+    """\
+    Store the header (bytes, matched case-insensitively) in Request.headers
+    of following requests. Other headers are skipped.
+    """
+    _wanted[name.lower()] = name
+    _wanted_lengths.add(len(name))
+
+
+for _name in (b'Content-Length', b'Content-Type', b'Content-Encoding', b'Connection',
+              b'Accept-Encoding', b'If-None-Match', b'If-Modified-Since'):
+    register_header(_name)
+
+
+class RequestError(Exception):
+    """Invalid request, to be answered with the given response"""
+    def __init__(self, response):
+        super().__init__(response.status)
+        self.response = response
 
 
 class Request(object):
@@ -13,29 +43,119 @@ class Request(object):
         self.connection = connection
         self.method = None
         self.path = None
-        self._read = False
+        self.version = None
+        self._query = None
+        self._remaining = 0   # bytes of the body not yet read
+        self._buffer = None   # for iter_content(), kept for the following requests
         self.headers = {}
 
+    def _readline(self):
+        line = self.connection.rfile.readline(MAX_LINE)
+        if line and not line.endswith(b'\n'):
+            # too long or connection closed in the middle of the line
+            raise RequestError(STATUS431 if len(line) >= MAX_LINE else STATUS400)
+        return line
+
     def _read_headers(self):
-        while True:
-            line = self.connection.rfile.readline().rstrip()
-            if not line:
-                break
-            key, value = line.split(b':', 1)
-            # XXX urldecode key, value, multiline values
-            self.parse_header(key, value)
+        for n in range(MAX_HEADERS + 1):
+            line = self._readline()
+            if line in (b'\r\n', b'\n', b''):
+                return
+            # only names with the length of a wanted one are looked up, so
+            # other headers cost no allocations besides the line itself
+            i = line.find(b':')
+            if i < 0:
+                raise RequestError(STATUS400)
+            if i in _wanted_lengths:
+                name = _wanted.get(line[:i].lower())
+                if name is not None:
+                    # XXX multiline values
+                    self.parse_header(name, line[i + 1:].strip())
+        raise RequestError(STATUS431)
 
     def _read_request(self):
+        """Read request line and headers, return False if the client closed the connection"""
         self.headers.clear()
-        self._read = False
-        commandline = self.connection.rfile.readline()
+        self._query = None
+        self._remaining = 0
+        commandline = self._readline()
+        # tolerate empty lines between pipelined requests
+        while commandline in (b'\r\n', b'\n'):
+            commandline = self._readline()
+        if not commandline:
+            return False
         #~ print(self.connection.name, commandline)
-        self.method, self.path, _ = commandline.strip().split(None, 2)
+        try:
+            self.method, self.path, self.version = commandline.strip().split(None, 2)
+        except ValueError:
+            raise RequestError(STATUS400)
         self._read_headers()
+        try:
+            self._remaining = int(self.headers.get(b'Content-Length', b'0'))
+        except ValueError:
+            raise RequestError(STATUS400)
+        if self._remaining < 0:
+            raise RequestError(STATUS400)
+        return True
+
+    @property
+    def query(self):
+        """Parameters of the query string as dict, decoded on first use"""
+        if self._query is None:
+            self._query = url.parse_query(url.split(self.path)[1])
+        return self._query
+
+    def keep_alive(self):
+        """True if the client wants to keep the connection open"""
+        connection = self.headers.get(b'Connection', b'').lower()
+        if self.version == b'HTTP/1.0':
+            return b'keep-alive' in connection
+        return b'close' not in connection
 
     def raw(self):
-        self._read = True
-        return self.connection.rfile.read(int(self.headers.get(b'Content-Length', b'0')))
+        """Read the (rest of the) body at once"""
+        data = self.connection.rfile.read(self._remaining)
+        self._remaining = 0
+        return data
+
+    def readinto(self, buf):
+        """\
+        Read the next part of the body into buf (bytearray or memoryview),
+        return the number of bytes, 0 at the end of the body.
+        """
+        if not self._remaining:
+            return 0
+        if len(buf) > self._remaining:
+            buf = memoryview(buf)[:self._remaining]
+        n = self.connection.rfile.readinto(buf)
+        if not n:
+            # connection closed early
+            self._remaining = 0
+            return 0
+        self._remaining -= n
+        return n
+
+    def iter_content(self, chunk_size=256, buf=None):
+        """\
+        Iterate over the body in chunks, e.g. to process uploads without
+        holding them in RAM. The chunks are memoryviews of buf (or of a
+        buffer of chunk_size that is allocated once per connection), they
+        are only valid until the next chunk is read.
+        """
+        if buf is None:
+            # not the shared buffer of web.response, a streamed response may
+            # use that while the body is read
+            if self._buffer is None or len(self._buffer) < chunk_size:
+                self._buffer = None
+                self._buffer = memoryview(bytearray(chunk_size))
+            buf = self._buffer[:chunk_size]
+        else:
+            buf = memoryview(buf)
+        while True:
+            n = self.readinto(buf)
+            if not n:
+                break
+            yield buf[:n]
 
     def text(self):
         return self.raw().decode(self.headers.get(b'Content-Encoding', 'utf-8'))
@@ -44,11 +164,20 @@ class Request(object):
         return json.loads(self.text())
 
     def parse_header(self, key, value):
-        # XXX store the interesting ones, XXX case senitivity
-        if key in [b'Content-Length', b'Content-Type', b'Content-Encoding']:
-            self.headers[key] = value
-        #~ print(key, value)
-
-    def cleanup(self):
-        if not self._read and b'Content-Length' in self.headers:
-            self.raw()  # read and drop data  XXX do it in small chunks
+        # called for registered headers only, see register_header()
+        self.headers[key] = value
+
+    def cleanup(self, limit=None):
+        """\
+        Read and drop the rest of the body, at most limit bytes (if given).
+        Return True if the whole body was read.
+        """
+        if self._remaining:
+            buf = get_buffer(256)
+            while limit is None or limit > 0:
+                n = self.readinto(buf)
+                if not n:
+                    break
+                if limit is not None:
+                    limit -= n
+        return not self._remaining
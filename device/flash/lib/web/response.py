@@ -7,10 +7,30 @@
 import json
 import sys
 import os
+import time
 from . import umimetypes
 
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# buffer shared for copying streams, responses are sent one at a time
+_buffer = None
+
+# cache of validators for served files: path -> (size, mtime, etag, last modified)
+_validators = {}
+
+
+def get_buffer(size):
+    """Return a memoryview of size bytes of the shared buffer"""
+    global _buffer
+    if _buffer is None or len(_buffer) < size:
+        _buffer = None
+        _buffer = memoryview(bytearray(size))
+    return _buffer[:size]
+
 
 class Response(object):
+    heads = None    # dict for constant responses, caching the encoded head, see constant()
 
     def __init__(self, status):
         self.status = status
@@ -18,16 +38,19 @@ class Response(object):
             b'Cache-Control': b'no-cache,no-store,must-revalidate',
         }
 
-    def emit_content(self, server):
-        pass
-
-    def emit(self, server):
+    def emit_head(self, server):
         server.send_response(self.status)
         for header_name, header_value in self.headers.items():
             if not isinstance(header_value, (bytes, bytearray, memoryview)):
                 header_value = str(header_value).encode('utf-8')
             server.send_header(header_name, header_value)
         server.end_headers()
+
+    def emit_content(self, server):
+        pass
+
+    def emit(self, server):
+        self.emit_head(server)
         self.emit_content(server)
 
 
@@ -44,23 +67,35 @@ class SimpleResponse(Response):
         self.headers[b'Content-Length'] = len(self.content)
 
     def emit_content(self, server):
-        server.wfile.write(self.content)
+        server.write(self.content)
 
 
 class StreamResponse(Response):
+    chunk_size = 256
 
-    def __init__(self, stream, length, content_type, status=b'200 OK'):
+    def __init__(self, stream, length, content_type, status=b'200 OK', chunk_size=None):
         super().__init__(status)
         self.stream = stream
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
         self.headers[b'Content-Type'] = content_type
         self.headers[b'Content-Length'] = length
 
     def emit_content(self, server):
-        while True:
-            chunk = self.stream.read(256)
-            if not chunk:
-                break
-            server.wfile.write(chunk)
+        if hasattr(self.stream, 'readinto'):
+            # copy via the shared buffer, no allocations per chunk
+            buf = get_buffer(self.chunk_size)
+            while True:
+                n = self.stream.readinto(buf)
+                if not n:
+                    break
+                server.write(buf if n == len(buf) else buf[:n])
+        else:
+            while True:
+                chunk = self.stream.read(self.chunk_size)
+                if not chunk:
+                    break
+                server.write(chunk)
         try:
             self.stream.close()
         except:
@@ -68,10 +103,117 @@ class StreamResponse(Response):
         self.stream = None
 
 
+class ChunkedResponse(Response):
+    """\
+    Send the items of an iterable (bytes or str, e.g. from a generator) as
+    they are produced, using chunked transfer encoding, so that the length
+    does not need to be known up front. Small items are collected in the
+    shared buffer, up to chunk_size bytes per chunk. HTTP/1.0 clients get
+    the plain data and the connection is closed to mark the end.
+    """
+    chunk_size = 256
+
+    def __init__(self, iterable, content_type, status=b'200 OK', chunk_size=None):
+        super().__init__(status)
+        self.iterable = iterable
+        self.chunked = True
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.headers[b'Content-Type'] = content_type
+
+    def emit_head(self, server):
+        self.chunked = server.http11
+        if self.chunked:
+            self.headers[b'Transfer-Encoding'] = b'chunked'
+        else:
+            server._keep = False
+        super().emit_head(server)
+
+    def emit_chunk(self, server, data):
+        if self.chunked:
+            server.write('{:x}\r\n'.format(len(data)).encode('utf-8'))
+            server.write(data)
+            server.write(b'\r\n')
+        else:
+            server.write(data)
+
+    def emit_content(self, server):
+        buf = get_buffer(self.chunk_size)
+        position = 0
+        try:
+            for data in self.iterable:
+                if not isinstance(data, (bytes, bytearray, memoryview)):
+                    data = str(data).encode('utf-8')
+                n = len(data)
+                if position + n > len(buf):
+                    if position:
+                        self.emit_chunk(server, buf[:position])
+                        position = 0
+                    if n > len(buf):
+                        self.emit_chunk(server, data)
+                        continue
+                buf[position:position + n] = data
+                position += n
+        except Exception as e:
+            # too late for an error response, closing the connection without
+            # the last chunk tells the client that the data is incomplete
+            sys.print_exception(e)
+            server._keep = False
+            if position:
+                self.emit_chunk(server, buf[:position])
+            return
+        if position:
+            self.emit_chunk(server, buf[:position])
+        if self.chunked:
+            server.write(b'0\r\n\r\n')
+
+
+_generator = type((lambda: (yield))())
+
+
+def iterencode(obj):
+    """\
+    Generate the JSON representation of obj in small pieces. Generators are
+    encoded as lists.
+    """
+    if isinstance(obj, dict):
+        yield '{'
+        separator = ''
+        for key, value in obj.items():
+            yield separator
+            yield json.dumps(str(key))
+            yield ':'
+            for piece in iterencode(value):
+                yield piece
+            separator = ','
+        yield '}'
+    elif isinstance(obj, (list, tuple, _generator)):
+        yield '['
+        separator = ''
+        for value in obj:
+            yield separator
+            for piece in iterencode(value):
+                yield piece
+            separator = ','
+        yield ']'
+    else:
+        yield json.dumps(obj)
+
+
+class JsonStreamResponse(ChunkedResponse):
+    """\
+    Alternative to JsonResponse for large objects, the JSON text is encoded
+    while sending instead of building it in memory first.
+    """
+    def __init__(self, obj, status=b'200 OK'):
+        super().__init__(iterencode(obj), b'application/json', status)
+
+
 class RedirectResponse(Response):
     def __init__(self, url):
         super().__init__(b'302 Moved Temporarily')
         self.headers[b'Location'] = url.encode('utf-8')  # XXX encoding of url
+        self.headers[b'Content-Length'] = 0
 
 
 class HtmlResponse(SimpleResponse):
@@ -84,17 +226,61 @@ class JsonResponse(SimpleResponse):
         super().__init__(json.dumps(obj), b'application/json')
 
 
-def FileResponse(path):
-    try:
-        s = os.stat(path)
-    except OSError:
+def http_date(seconds):
+    t = getattr(time, 'gmtime', time.localtime)(seconds)
+    return '{}, {:02d} {} {} {:02d}:{:02d}:{:02d} GMT'.format(
+        WEEKDAYS[t[6]], t[2], MONTHS[t[1] - 1], t[0], t[3], t[4], t[5]).encode('utf-8')
+
+
+def _file_validators(path, s):
+    """ETag and Last-Modified header values, cached per file as long as size and mtime match"""
+    size, mtime = s[6], s[8]
+    cached = _validators.get(path)
+    if cached is None or cached[0] != size or cached[1] != mtime:
+        etag = '"{:x}-{:x}{}"'.format(size, mtime, '-gz' if path.endswith('.gz') else '').encode('utf-8')
+        cached = (size, mtime, etag, http_date(mtime))
+        _validators[path] = cached
+    return cached[2], cached[3]
+
+
+def FileResponse(path, request=None):
+    """\
+    Serve a file. A pre-compressed "<path>.gz" is preferred when the client
+    accepts gzip (and used in any case when the plain file is missing).
+    With a request, If-None-Match and If-Modified-Since are answered with
+    "304 Not Modified" without opening the file.
+    """
+    headers = request.headers if request is not None else {}
+    if b'gzip' in headers.get(b'Accept-Encoding', b''):
+        candidates = (path + '.gz', path)
+    else:
+        candidates = (path, path + '.gz')
+    for filename in candidates:
+        try:
+            s = os.stat(filename)
+            break
+        except OSError:
+            pass
+    else:
         return STATUS404
+    etag, last_modified = _file_validators(filename, s)
+    if b'If-None-Match' in headers:
+        not_modified = etag in headers[b'If-None-Match'] or headers[b'If-None-Match'] == b'*'
+    else:
+        not_modified = headers.get(b'If-Modified-Since') == last_modified
+    if not_modified:
+        response = Response(b'304 Not Modified')
     else:
         fileext = path.split('.')[-1]
         mime_type = umimetypes.type_map.get(fileext, b'application/octet-stream')
-        response = StreamResponse(open(path, 'rb'), s[6], mime_type)  # stream, len
-        response.headers[b'Cache-Control'] = b'max-age: 30'
-        return response
+        response = StreamResponse(open(filename, 'rb'), s[6], mime_type)  # stream, len
+        if filename != path:
+            response.headers[b'Content-Encoding'] = b'gzip'
+    response.headers[b'Cache-Control'] = b'max-age=30'
+    response.headers[b'ETag'] = etag
+    response.headers[b'Last-Modified'] = last_modified
+    response.headers[b'Vary'] = b'Accept-Encoding'
+    return response
 
 
 class ErrorResponse(HtmlResponse):
@@ -103,11 +289,23 @@ class ErrorResponse(HtmlResponse):
         self.headers[b'Content-Length'] = len(self.content) + len(self.status)
 
     def emit_content(self, server):
-        server.wfile.write(self.content)
-        server.wfile.write(self.status)
+        server.write(self.content)
+        server.write(self.status)
+
+
+def constant(response):
+    """\
+    Mark a response that is sent unchanged many times, the connection then
+    encodes its head only once. Its headers must not be modified afterwards.
+    """
+    response.heads = {}
+    return response
 
 
-STATUS200 = Response(b'200 OK')
-STATUS204 = Response(b'204 No Content')
-STATUS500 = ErrorResponse(b'500 Internal Server Error')
-STATUS404 = ErrorResponse(b'404 Not Found')
+STATUS200 = constant(Response(b'200 OK'))
+STATUS200.headers[b'Content-Length'] = 0
+STATUS204 = constant(Response(b'204 No Content'))
+STATUS500 = constant(ErrorResponse(b'500 Internal Server Error'))
+STATUS404 = constant(ErrorResponse(b'404 Not Found'))
+STATUS400 = constant(ErrorResponse(b'400 Bad Request'))
+STATUS431 = constant(ErrorResponse(b'431 Request Header Fields Too Large'))
@@ -7,17 +7,83 @@
 import socket
 import sys
 import gc
-import micropython
+try:
+    import micropython
+except ImportError:
+    micropython = None
 from .connection import Connection
+from .request import Request
+from .response import STATUS431
+from .ticks import ticks_ms, ticks_add, ticks_diff
 import ulog
 gc.collect()
 
 log = ulog.Logger('HTTPD: ')
 
+EAGAIN = 11
+MAX_REQUEST_HEAD = 2048
+
+
+class _SocketReader(object):
+    """\
+    File like object to read from a socket. The data that was received while
+    waiting for the request head is returned first.
+    """
+    def __init__(self, sock, data):
+        self.sock = sock
+        self.data = data
+        # MicroPython sockets are streams, CPython ones have recv_into()
+        self._readinto = getattr(sock, 'readinto', None) or sock.recv_into
+
+    def _fill(self):
+        chunk = self.sock.recv(256)
+        self.data += chunk
+        return chunk
+
+    def readline(self, size=-1):
+        while True:
+            n = self.data.find(b'\n') + 1
+            if n or 0 <= size <= len(self.data) or not self._fill():
+                break
+        if not n:
+            n = len(self.data)
+        if 0 <= size < n:
+            n = size
+        line = self.data[:n]
+        self.data = self.data[n:]
+        return line
+
+    def read(self, size):
+        while len(self.data) < size and self._fill():
+            pass
+        chunk = self.data[:size]
+        self.data = self.data[size:]
+        return chunk
+
+    def readinto(self, buf):
+        n = len(self.data)
+        if not n:
+            return self._readinto(buf)
+        n = min(n, len(buf))
+        buf[:n] = self.data[:n]
+        self.data = self.data[n:]
+        return n
+
 
 class Server(object):
-    def __init__(self, app, port=80):
+    def __init__(self, app, port=80, backlog=1, keep_alive=None, idle_timeout=2, max_requests=20):
+        """\
+        With keep_alive, connections are kept open for up to max_requests
+        requests, as long as the client sends the next one within idle_timeout
+        seconds. Note that loop() serves one connection at a time, so that
+        other clients have to wait for that time. The default (None) is to
+        keep connections open only when serving with start().
+        """
         self.app = app
+        self.scheduler = None
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
 
         self.listening_socket = socket.socket()
 
@@ -31,18 +97,18 @@ class Server(object):
         except AttributeError:
             log.warn('setsockopt not supported')
         self.listening_socket.bind(addr)
-        self.listening_socket.listen(1)
+        self.listening_socket.listen(backlog)
 
     def wait_for_client(self):
         client_socket, client_addr = self.listening_socket.accept()
-        #~ client_socket.settimeout(5)
+        client_socket.settimeout(self.idle_timeout)
         try:
             connection = Connection(
                 '{}:{}'.format(*client_addr).encode('utf-8'),
                 client_socket.makefile('rb'),
                 client_socket.makefile('wb'),
-                #~ keep=True)
-                keep=False)
+                keep=bool(self.keep_alive),
+                max_requests=self.max_requests)
             connection.do_request(self.app)
         finally:
             #~ print("terminate")
@@ -52,7 +118,8 @@ class Server(object):
     def loop(self):
         self.app.optimize_routes()
         gc.collect()
-        micropython.mem_info(1)
+        if micropython is not None:
+            micropython.mem_info(1)
         while True:
             try:
                 self.wait_for_client()
@@ -67,3 +134,80 @@ class Server(object):
             except Exception as e:
                 #~ raise
                 sys.print_exception(e)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # alternative to loop(): serve multiple clients as tasks of a scheduler
+
+    def start(self, scheduler, max_clients=3, timeout=5):
+        """\
+        Serve clients as tasks of the given scheduler.Scheduler, instead of
+        blocking in loop(). The request head is received without blocking,
+        the tasks wait for their sockets to be readable, so slow clients do
+        not stall the other tasks; once it is complete, the request is
+        answered with a socket in blocking mode (with timeout in seconds).
+        """
+        from scheduler import Readable
+        self.Readable = Readable
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.max_clients = max_clients
+        self.clients = 0
+        self.client_done = scheduler.new_flag()
+        self.app.optimize_routes()
+        self.listening_socket.setblocking(False)
+        scheduler.run(self._accept_task).name = 'httpd'
+
+    def _accept_task(self):
+        readable = self.Readable(self.listening_socket)
+        while True:
+            if self.clients >= self.max_clients:
+                yield self.client_done
+                continue
+            yield readable
+            try:
+                client_socket, client_addr = self.listening_socket.accept()
+            except OSError:
+                continue
+            self.clients += 1
+            self.scheduler.run(lambda: self._client_task(client_socket, client_addr)).name = 'httpd client'
+
+    def _client_task(self, client_socket, client_addr):
+        reader = _SocketReader(client_socket, b'')
+        readable = self.Readable(client_socket)
+        connection = Connection(
+            '{}:{}'.format(*client_addr).encode('utf-8'),
+            reader,
+            client_socket.makefile('wb'),
+            keep=self.keep_alive is not False,
+            max_requests=self.max_requests)
+        request = Request(connection)
+        try:
+            while True:
+                client_socket.setblocking(False)
+                deadline = ticks_add(ticks_ms(), self.idle_timeout * 1000)
+                # wait until the request head is complete, without blocking
+                # others. pipelined requests may already be in the buffer.
+                while b'\r\n\r\n' not in reader.data:
+                    if len(reader.data) > MAX_REQUEST_HEAD:
+                        client_socket.settimeout(self.timeout)
+                        connection.reject(STATUS431)
+                        return
+                    try:
+                        chunk = client_socket.recv(256)
+                    except OSError as e:
+                        readable.timeout = ticks_diff(deadline, ticks_ms())
+                        if e.args[0] != EAGAIN or readable.timeout <= 0:
+                            return
+                        yield readable
+                        continue
+                    if not chunk:
+                        return
+                    reader.data += chunk
+                client_socket.settimeout(self.timeout)
+                if not connection.handle_request(self.app, request):
+                    return
+        finally:
+            self.clients -= 1
+            self.scheduler.set_flag(self.client_done)
+            client_socket.close()
+            gc.collect()
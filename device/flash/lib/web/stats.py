@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+#
+# (C) 2016 Chris Liechti <cliechti@gmx.net>
+#
+# SPDX-License-Identifier:    BSD-3-Clause
+"""\
+Request statistics, recorded by hooks of an App and served as JSON. The
+statistics of a scheduler.Scheduler can be served too.
+"""
+import gc
+from array import array
+from . import connection as _connection
+from .response import JsonResponse
+from .ticks import ticks_us, ticks_diff
+
+# CPython has no mem_free()
+_mem_free = getattr(gc, 'mem_free', lambda: 0)
+
+
+class RequestStats(object):
+    """\
+    Record the latency (us, handling and sending), the bytes sent and the
+    change of free heap of the last size requests in a ring buffer.
+    Requests answered by an earlier before-hook are not recorded.
+    Optionally, each request is also logged with the given ulog.Logger.
+    """
+    def __init__(self, size=16, log=None):
+        self.size = size
+        self.log = log
+        self.count = 0
+        self.latency = array('l', [0] * size)
+        self.sent = array('l', [0] * size)
+        self.heap = array('l', [0] * size)
+        self.requests = [None] * size  # (method, path, status)
+        self._start = None  # set by before(), None if it did not run
+        self._free = 0
+
+    def install(self, app, path='/_stats'):
+        """Add the hooks to app and serve the statistics at path (if not None)"""
+        app.before_request(self.before)
+        app.after_request(self.after)
+        if path is not None:
+            app.add_route(b'GET', path, self.handle)
+        return self
+
+    def before(self, request):
+        self._free = _mem_free()
+        self._start = ticks_us()
+
+    def after(self, request, response, connection):
+        if self._start is None:
+            return
+        i = self.count % self.size
+        self.latency[i] = ticks_diff(ticks_us(), self._start)
+        self._start = None
+        self.sent[i] = connection.response_bytes
+        self.heap[i] = self._free - _mem_free()
+        self.requests[i] = (request.method, request.path, response.status)
+        self.count += 1
+        if self.log is not None:
+            self.log.debug('{} {} -> {}: {} us, {} bytes, heap {:+d}'.format(
+                request.method.decode('utf-8'), request.path.decode('utf-8'),
+                response.status.decode('utf-8'), self.latency[i], self.sent[i], -self.heap[i]))
+
+    def recent(self):
+        """List of dicts, newest first"""
+        entries = []
+        for n in range(min(self.count, self.size)):
+            i = (self.count - 1 - n) % self.size
+            method, path, status = self.requests[i]
+            entries.append({
+                'method': method.decode('utf-8'),
+                'path': path.decode('utf-8'),
+                'status': status.decode('utf-8'),
+                'us': self.latency[i],
+                'bytes': self.sent[i],
+                'heap': self.heap[i],
+            })
+        return entries
+
+    def as_dict(self):
+        n = min(self.count, self.size)
+        policy = _connection.gc_policy
+        return {
+            'requests': self.count,
+            'max_us': max(self.latency[:n]) if n else 0,
+            'avg_us': sum(self.latency[:n]) // n if n else 0,
+            'avg_bytes': sum(self.sent[:n]) // n if n else 0,
+            'mem_free': _mem_free(),
+            'gc': {'min_free': policy.min_free, 'runs': policy.runs, 'skipped': policy.skipped, 'us': policy.us},
+            'recent': self.recent(),
+        }
+
+    def handle(self, request):
+        return JsonResponse(self.as_dict())
+
+
+def add_scheduler_route(app, scheduler, path='/_tasks'):
+    """Serve Scheduler.stats() as JSON, with ?reset=1 the loop counters are reset"""
+    app.add_route(b'GET', path, lambda request: JsonResponse(
+        scheduler.stats(reset=request.query.get('reset') == '1')))
@@ -0,0 +1,21 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+#
+# (C) 2016 Chris Liechti <cliechti@gmx.net>
+#
+# SPDX-License-Identifier:    BSD-3-Clause
+"""\
+Time functions of MicroPython, with replacements for CPython (e.g. tests).
+"""
+import time
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_us = time.ticks_us
+    ticks_add = time.ticks_add
+    ticks_diff = time.ticks_diff
+except AttributeError:
+    ticks_ms = lambda: int(time.monotonic() * 1000)
+    ticks_us = lambda: int(time.monotonic() * 1000000)
+    ticks_add = lambda a, b: a + b
+    ticks_diff = lambda a, b: a - b
@@ -6,11 +6,55 @@
 # SPDX-License-Identifier:    BSD-3-Clause
 
 
-def decode(b_url):  # expecting bytes
-    parts = b_url.split(b'%')
-    d = bytearray(parts[0])  # the 1st is special
-    for part in parts[1:]:
-        if part:
-            d.append(int(part[:2], 16))
-            d.extend(part[2:])
-    return bytes(d).decode('utf-8')
+# value of each byte as hex digit, 0xff for the others
+_HEX = bytearray(b'\xff' * 256)
+for _i, _c in enumerate(b'0123456789abcdef'):
+    _HEX[_c] = _i
+for _i, _c in enumerate(b'ABCDEF', 10):
+    _HEX[_c] = _i
+
+
+def decode(b_url, plus=False):  # expecting bytes
+    """\
+    Percent-decode, return str. With plus, '+' is decoded as space (as used
+    in query strings). Invalid escapes are kept as they are.
+    """
+    if plus and b'+' in b_url:
+        b_url = b_url.replace(b'+', b' ')
+    if b'%' not in b_url:
+        return b_url.decode('utf-8')
+    parts = iter(b_url.split(b'%'))
+    d = bytearray(next(parts))  # the 1st is special
+    digit = _HEX
+    for part in parts:
+        if len(part) > 1:
+            high = digit[part[0]]
+            low = digit[part[1]]
+            if high | low < 0x10:
+                d.append(high << 4 | low)
+                if len(part) > 2:
+                    d += part[2:]
+                continue
+        d.append(0x25)  # '%', not a valid escape
+        d += part
+    return str(d, 'utf-8')  # no intermediate bytes copy
+
+
+def split(b_url):
+    """Split into path and query string (None if there is no '?')"""
+    i = b_url.find(b'?')
+    if i < 0:
+        return b_url, None
+    return b_url[:i], b_url[i + 1:]
+
+
+def parse_query(b_query):
+    """Decode a query string to a dict, the last one wins for repeated names"""
+    params = {}
+    if b_query:
+        for field in b_query.split(b'&'):
+            if not field:
+                continue
+            key_value = field.split(b'=', 1)
+            params[decode(key_value[0], True)] = decode(key_value[1], True) if len(key_value) > 1 else ''
+    return params
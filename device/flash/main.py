@@ -12,23 +12,34 @@ import expansionboard
 import autoconfig
 import upathlib
 import ulog
+import boottrace
+boottrace.mark('imports')
 
 if machine.reset_cause() != machine.SOFT_RESET:
     autoconfig.wlan()
+    boottrace.mark('wlan')
 
 
 ulog_config = upathlib.Path('/flash/ulogconfig.py')
 if ulog_config.exists():
     execfile(str(ulog_config))
 del ulog_config
+boottrace.mark('ulogconfig')
 
-if expansionboard.initialize_sd_card():
+sd_mounted = expansionboard.initialize_sd_card()
+boottrace.mark('sd')
+if sd_mounted:
+    # /sd/main.py may run forever, so report what is known now
+    boottrace.report()
     main = upathlib.Path('/sd/main.py')
     ulog.root.info('execute {}...'.format(main))
     if main.exists():
         execfile(str(main))
+        boottrace.mark('sd_main')
     else:
         ulog.root.warn('no file {} found!'.format(main))
     del main
+del sd_mounted
+boottrace.report()
 
 
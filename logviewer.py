@@ -7,6 +7,7 @@
 """\
 Simple rsyslog (subset thereof) viewer.
 """
+import ast
 import datetime
 import logging
 import re
@@ -16,9 +17,81 @@ import sys
 prio_text = ('EMERG', 'ALERT', 'CRIT', 'ERR', 'WARN', 'NOTICE', 'INFO', 'DEBUG')
 
 re_syslog = re.compile(r'<(?P<pri>\d+)> (?P<msg>.*)')  # XXX simplified subset
+# message of boottrace.py
+re_boottrace = re.compile(r'BOOT: trace (?P<items>.*)')
+# line written by log_receiver
+re_logline = re.compile(r'\S+ \S+ (?P<host>[^:\s]+):\d+ : \w+ (?P<msg>.*)$')
 
 
-def log_receiver(output, port):
+class BootReport(object):
+    """Aggregate boot traces (see device/flash/lib/boottrace.py) per board and stage"""
+    def __init__(self):
+        self.boots = {}     # board -> number of boots
+        self.stages = {}    # board -> {stage: [(ms, free), ...]}
+        self.order = []     # stage names in order of appearance
+
+    def add(self, board, message):
+        """\
+        Process a log message, return True if it was a boot trace. Raises
+        ValueError for malformed traces, nothing of them is recorded then.
+        """
+        m = re_boottrace.match(message)
+        if m is None:
+            return False
+        reset = False
+        items = []
+        for item in m.group('items').split():
+            name, value = item.split('=', 1)
+            if name == 'reset':
+                reset = True
+                continue
+            ms, free = value.split('/')
+            items.append((name, int(ms), int(free)))
+        if reset:
+            self.boots[board] = self.boots.get(board, 0) + 1
+        stages = self.stages.setdefault(board, {})
+        for name, ms, free in items:
+            if name not in self.order:
+                self.order.append(name)
+            stages.setdefault(name, []).append((ms, free))
+        return True
+
+    def read(self, lines):
+        """Read lines that were previously written by log_receiver"""
+        for line in lines:
+            m = re_logline.match(line)
+            if m is not None:
+                try:
+                    self.add(m.group('host'), ast.literal_eval(m.group('msg')))
+                except (ValueError, SyntaxError):
+                    pass
+
+    def write(self, output):
+        rows = [(board, self.stages[board]) for board in sorted(self.stages)]
+        if len(rows) > 1:
+            combined = {}
+            for _, stages in rows:
+                for name, values in stages.items():
+                    combined.setdefault(name, []).extend(values)
+            rows.append(('(all)', combined))
+        output.write('{:<16} {:<12} {:>5} {:>7} {:>7} {:>7} {:>9}\n'.format(
+            'board', 'stage', 'count', 'min ms', 'avg ms', 'max ms', 'min free'))
+        for board, stages in rows:
+            if board == '(all)':
+                boots = sum(self.boots.values())
+            else:
+                boots = self.boots.get(board, 0)
+            output.write('{} ({} boots)\n'.format(board, boots))
+            for name in self.order:
+                if name in stages:
+                    times = [ms for ms, free in stages[name]]
+                    output.write('{:<16} {:<12} {:>5} {:>7} {:>7.0f} {:>7} {:>9}\n'.format(
+                        '', name, len(times), min(times), sum(times) / len(times), max(times),
+                        min(free for ms, free in stages[name])))
+        output.flush()
+
+
+def log_receiver(output, port, report=None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind(('0.0.0.0', port))
     logging.info("Press CTRL+C to exit")
@@ -27,6 +100,11 @@ def log_receiver(output, port):
         if data:
             m = re_syslog.match(data.decode('utf-8'))
             if m is not None:
+                if report is not None:
+                    try:
+                        report.add(address[0], m.group('msg'))
+                    except ValueError:
+                        logging.warning('invalid boot trace from {}'.format(address[0]))
                 pri = int(m.group('pri'))
                 priority = pri & 7
                 facility = pri >> 3
@@ -52,17 +130,29 @@ def main():
 
     parser.add_argument('-v', '--verbose', action='store_true', help='show more diagnostic messages')
     parser.add_argument('-p', '--port', default=5140, type=int, help='specify UDP port to listen to (default: %(default)s)')
+    parser.add_argument('--boot-report', action='store_true', help='collect boot traces and print a summary on exit')
+    parser.add_argument('--read', metavar='FILE', nargs='+', help='with --boot-report: evaluate saved output of this tool instead of listening')
 
     args = parser.parse_args()
     #~ print(args)
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
+    report = BootReport() if args.boot_report else None
+    if report is not None and args.read:
+        for filename in args.read:
+            with open(filename) as f:
+                report.read(f)
+        report.write(sys.stdout)
+        return
+
     try:
-        log_receiver(sys.stdout, args.port)
+        log_receiver(sys.stdout, args.port, report)
     except (IOError, SystemExit):
         raise
     except KeyboardInterrupt:
         logging.info("Exit")
+    if report is not None:
+        report.write(sys.stdout)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 if __name__ == "__main__":
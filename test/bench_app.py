@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+#
+# (C) 2016 Chris Liechti <cliechti@gmx.net>
+#
+# SPDX-License-Identifier:    BSD-3-Clause
+"""\
+Benchmark route lookup of web.app.App against the previous linear list of
+regexps, with a few dozen routes.
+"""
+
+import os
+import re
+import sys
+import timeit
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(__file__), '../device/flash/lib'))
+from web.app import App
+
+
+class LinearApp(object):
+    """the previous implementation, every regexp is tried in order"""
+    def __init__(self):
+        self.routes = {}
+
+    def handle_request(self, request, path):
+        for priority, _, regexp, function in self.routes[request.method]:
+            m = regexp.match(path)
+            if m is not None:
+                args = []
+                try:
+                    for i in range(1, 10):
+                        args.append(m.group(i))
+                except IndexError:
+                    pass
+                return function(request, *args)
+        return None
+
+    def optimize_routes(self):
+        for handlers in self.routes.values():
+            handlers.sort(key=lambda x: x[0])
+            handlers.reverse()
+
+    def add_route(self, verb, path, function):
+        priority = path.count('/')
+        if not path.endswith('$'):
+            path = path + '$'
+        self.routes.setdefault(verb, []).append((priority, path, re.compile(path), function))
+        return function
+
+
+class Request(object):
+    method = b'GET'
+
+
+def handler(request, *args):
+    return args
+
+
+def make_routes(app, typed):
+    for n in range(20):
+        app.add_route(b'GET', '/page{}'.format(n), handler)
+        app.add_route(b'GET', '/api/v1/sensor{}'.format(n), handler)
+        if typed:
+            app.add_route(b'GET', '/api/v1/sensor{}/<int:index>'.format(n), handler)
+        else:
+            app.add_route(b'GET', '/api/v1/sensor{}/([0-9]+)'.format(n), handler)
+    app.add_route(b'GET', '/static/(.*)', handler)
+    app.optimize_routes()
+    return app
+
+
+PATHS = ['/page0', '/page19', '/api/v1/sensor10', '/api/v1/sensor19/42', '/static/css/style.css', '/missing']
+
+
+def main():
+    request = Request()
+    for name, app in (('linear', make_routes(LinearApp(), False)), ('trie', make_routes(App(), True))):
+        for path in PATHS:
+            t = timeit.timeit(lambda: app.handle_request(request, path), number=10000)
+            print('{:7} {:24} {:6.2f} us/lookup'.format(name, path, t * 100))
+
+
+if __name__ == '__main__':
+    main()
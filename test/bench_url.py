@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+# encoding: utf-8
+#
+# (C) 2016 Chris Liechti <cliechti@gmx.net>
+#
+# SPDX-License-Identifier:    BSD-3-Clause
+"""\
+Benchmark web.url.decode against the previous implementation: time and
+peak of temporarily allocated memory per call (as a hint for the
+MicroPython heap, where allocations are expensive).
+"""
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(__file__), '../device/flash/lib'))
+from web import url
+
+
+def old_decode(b_url):
+    """the previous implementation"""
+    parts = b_url.split(b'%')
+    d = bytearray(parts[0])  # the 1st is special
+    for part in parts[1:]:
+        if part:
+            d.append(int(part[:2], 16))
+            d.extend(part[2:])
+    return bytes(d).decode('utf-8')
+
+
+PATHS = [
+    b'/',
+    b'/api/v1/sensor/42',
+    b'/files/some%20file%20name.txt',
+    b'/%C3%A4%C3%B6%C3%BC/%E2%82%AC/%20%20%20%20%20%20',
+]
+
+
+def _peak_memory(function, argument):
+    tracemalloc.start()
+    function(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def peak_memory(function, argument):
+    """bytes allocated while running function, without the overhead of the call"""
+    _peak_memory(function, argument)
+    return _peak_memory(function, argument) - _peak_memory(len, argument)
+
+
+def main():
+    for name, function in (('old', old_decode), ('new', url.decode)):
+        for path in PATHS:
+            t = timeit.timeit(lambda: function(path), number=20000)
+            print('{:4} {:50} {:6.2f} us/call {:5} bytes peak'.format(
+                name, path.decode('ascii'), t * 50, peak_memory(function, path)))
+
+
+if __name__ == '__main__':
+    main()
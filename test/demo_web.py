@@ -10,6 +10,7 @@ Demo for the web service.
 
 import os
 import sys
+import time
 
 if __name__ == '__main__':
     import traceback
@@ -18,8 +19,11 @@ if __name__ == '__main__':
 
 
 def main():
-    from web.server import Server, HtmlResponse
+    from web.server import Server
+    from web.response import ChunkedResponse, HtmlResponse
     from web.app import App
+    from web.cache import add_stats_route
+    from web.stats import RequestStats, add_scheduler_route
     app = App()
 
     @app.route('/')
@@ -30,27 +34,51 @@ def main():
     def thing(request, t):
         return HtmlResponse("Thing: {!r}".format(t))
 
+    @app.route('/item/<int:number>')
+    def item(request, number):
+        return HtmlResponse("Item: {!r}".format(number))
+
+    # rendered at most once per second, other requests are answered from the cache
+    @app.route('/time', ttl=1)
+    def now(request):
+        return HtmlResponse("Rendered at {}".format(time.time()))
+
+    add_stats_route(app)
+
+    # latency, bytes and heap usage of the last requests at /_stats
+    RequestStats().install(app)
+
+    @app.route('/count/<int:n>')
+    def count(request, n):
+        # generated while sending, without holding all of it in memory
+        return ChunkedResponse(('{}\n'.format(i) for i in range(n)), b'text/plain')
+
     @app.route('/echo', b'POST')
     def echo(request):
-        data = request.rfile.read(int(request.headers[b'Content-Length']))
+        data = request.raw()
         return HtmlResponse("Echo: {!r}".format(data))
 
-    # apps can be nested with a little code
+    # apps can be nested
     app2 = App()
 
     @app2.route('/')
     def index(request):
         return HtmlResponse("Success 2")
 
-    app2.optimize_routes() # must be called manually
-
-    # delegate everything under a path to an other app, note that the slash is included in the regexp group
-    @app.route('/app2(/.*)')
-    def subapp(request, path):
-        return app2.handle_request(request, path)
+    # delegate everything under a path to an other app
+    app.mount('/app2', app2)
 
     server = Server(app, port=8080)
-    server.loop()
+    if '--scheduler' in sys.argv:
+        # serve multiple clients concurrently, as tasks of a scheduler
+        import scheduler
+        s = scheduler.Scheduler()
+        # tasks, their run counts and times at /_tasks
+        add_scheduler_route(app, s)
+        server.start(s)
+        s.loop()
+    else:
+        server.loop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+"""\
+Tests for logviewer.py.
+"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import logviewer
+
+# messages as sent by boottrace.report()
+TRACE = 'BOOT: trace reset=1 boot=12/40000 wlan=805/31000 main=20/30500'
+TRACE_2 = 'BOOT: trace boot=14/39000 main=30/30000'
+
+
+class FakeSocket(object):
+    """Replacement for the UDP socket, receives the given datagrams, then stops the receiver"""
+    def __init__(self, datagrams):
+        self.datagrams = list(datagrams)
+
+    def __call__(self, family, kind):
+        return self
+
+    def bind(self, address):
+        pass
+
+    def recvfrom(self, size):
+        if not self.datagrams:
+            raise KeyboardInterrupt()
+        return self.datagrams.pop(0), ('10.0.0.2', 514)
+
+
+class Test_BootReport(unittest.TestCase):
+
+    def test_add(self):
+        report = logviewer.BootReport()
+        self.assertFalse(report.add('a', 'some other message'))
+        self.assertTrue(report.add('a', TRACE))
+        self.assertTrue(report.add('a', TRACE_2))
+        self.assertEqual(report.boots, {'a': 1})
+        self.assertEqual(report.order, ['boot', 'wlan', 'main'])
+        self.assertEqual(report.stages['a']['boot'], [(12, 40000), (14, 39000)])
+        output = io.StringIO()
+        report.write(output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1], 'a (1 boots)')
+        self.assertEqual(lines[2].split(), ['boot', '2', '12', '13', '14', '39000'])
+
+    def test_malformed(self):
+        """nothing of a malformed trace is recorded"""
+        report = logviewer.BootReport()
+        for message in ('BOOT: trace reset=1 boot', 'BOOT: trace reset=1 boot=12', 'BOOT: trace boot=x/1'):
+            self.assertRaises(ValueError, report.add, 'a', message)
+        self.assertEqual((report.boots, report.stages, report.order), ({}, {}, []))
+
+    def test_read(self):
+        """lines saved by log_receiver are evaluated"""
+        report = logviewer.BootReport()
+        report.read([
+            '2016-05-01 12:00 10.0.0.2:514 : NOTICE {!r}\n'.format(TRACE),
+            '2016-05-01 12:00 10.0.0.3:514 : NOTICE {!r}\n'.format('BOOT: trace boot=x'),
+            'garbage\n',
+        ])
+        self.assertEqual(report.boots, {'10.0.0.2': 1})
+        self.assertEqual(sorted(report.stages), ['10.0.0.2'])
+
+    def test_receiver(self):
+        """malformed traces do not stop the receiver"""
+        report = logviewer.BootReport()
+        original = logviewer.socket.socket
+        logviewer.socket.socket = FakeSocket([
+            '<13> BOOT: trace boot=1'.encode('utf-8'),
+            '<13> {}'.format(TRACE).encode('utf-8'),
+        ])
+        output = io.StringIO()
+        try:
+            self.assertRaises(KeyboardInterrupt, logviewer.log_receiver, output, 5140, report)
+        finally:
+            logviewer.socket.socket = original
+        self.assertEqual(report.boots, {'10.0.0.2': 1})
+        self.assertEqual(len(output.getvalue().splitlines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ Tests for task scheduler.
 """
 
 import os
+import select
+import socket
 import sys
 import time
 import traceback
@@ -55,7 +57,7 @@ class TestScheduler(scheduler.Scheduler):
     def sleep(self):
         self.trace("sleep")
         self.low_power.clear()
-        self.low_power.wait()
+        self.low_power.wait(None if self.sleep_timeout is None else self.sleep_timeout / 1000)
 
     def wakeup(self):
         self.trace("wakeup")
@@ -81,7 +83,7 @@ class TestScheduler(scheduler.Scheduler):
     def get_trace(self):
         try:
             n = self.history.index('abort')
-        except IndexError:
+        except ValueError:
             return self.history
         else:
             return self.history[:n]
@@ -143,6 +145,615 @@ class Test_scheduler(unittest.TestCase):
         self.assertEqual(countdown, 0)
 
 
+class Test_scheduler_timers(unittest.TestCase):
+
+    def test_delay(self):
+        """Tasks can wait for a time, the scheduler sleeps meanwhile"""
+        s = TestScheduler()
+        stopwatch = Stopwatch()
+
+        def waiting():
+            delay = scheduler.Delay(100)
+            with stopwatch:
+                for i in range(3):
+                    yield delay
+            raise scheduler.ExitScheduler()
+
+        s.run(waiting)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertTrue(0.299 < stopwatch.elapsed_time < 0.4)
+        self.assertLessEqual(s.get_trace().count('sleep'), 6)
+
+    def test_order(self):
+        """Timers expire in the order of their deadlines"""
+        s = TestScheduler()
+        order = []
+
+        def waiting(ms):
+            yield scheduler.Delay(ms)
+            order.append(ms)
+            if len(order) == 3:
+                raise scheduler.ExitScheduler()
+
+        for ms in (150, 50, 100):
+            s.run(lambda ms=ms: waiting(ms))
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertEqual(order, [50, 100, 150])
+
+    def test_timeout(self):
+        """A Delay with a mask is ended early by a flag"""
+        s = TestScheduler()
+        flag = s.new_flag()
+        stopwatch = Stopwatch()
+
+        def waiting():
+            with stopwatch:
+                yield scheduler.Delay(1000, flag)
+            # the stale timer must not wake up the task later
+            yield flag
+            raise scheduler.ExitScheduler()
+
+        s.run(waiting)
+        threading.Timer(0.1, lambda: s.set_flag(flag)).start()
+        threading.Timer(1.5, lambda: s.set_flag(flag)).start()
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertTrue(0.09 < stopwatch.elapsed_time < 0.3)
+        self.assertEqual(s.next_timeout(), None)
+
+    def test_periodic(self):
+        """Periodic delays do not drift with the run time of the task"""
+        s = TestScheduler()
+        stopwatch = Stopwatch()
+
+        def periodic():
+            delay = scheduler.Delay(100, periodic=True)
+            with stopwatch:
+                for i in range(5):
+                    time.sleep(0.03)
+                    yield delay
+            raise scheduler.ExitScheduler()
+
+        s.run(periodic)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertTrue(0.45 < stopwatch.elapsed_time < 0.58)
+
+    def test_rebase(self):
+        """The clock is moved back before it gets large, deadlines are adjusted"""
+        s = TestScheduler()
+        s.now = scheduler.CLOCK_LIMIT - 50
+
+        def waiting():
+            yield scheduler.Delay(100)
+            raise scheduler.ExitScheduler()
+
+        s.run(waiting)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop, 1)
+        self.assertLess(s.now, 1000)
+
+    def test_default_sleep(self):
+        """The default sleep blocks until the timeout or a wakeup"""
+        s = scheduler.Scheduler()
+        stopwatch = Stopwatch()
+        s.sleep_timeout = 50
+        with stopwatch:
+            s.sleep()
+        self.assertTrue(0.045 < stopwatch.elapsed_time < 0.2)
+        s.sleep_timeout = None
+        threading.Timer(0.05, s.wakeup).start()
+        with stopwatch:
+            s.sleep()
+        self.assertTrue(0.09 < stopwatch.elapsed_time < 0.3)
+
+    def test_old_sleep(self):
+        """Subclasses with the sleep() signature of earlier versions still work"""
+        class OldScheduler(scheduler.Scheduler):
+            def sleep(self):
+                time.sleep(0.01)
+
+        s = OldScheduler()
+
+        def waiting():
+            yield scheduler.Delay(30)
+            raise scheduler.ExitScheduler()
+
+        s.run(waiting)
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+
+    def test_stale_timers(self):
+        """Timers of tasks woken by flags do not pile up"""
+        s = scheduler.Scheduler()
+        flag = s.new_flag()
+        sizes = []
+
+        def waiting():
+            for i in range(100):
+                yield scheduler.Delay(100000, flag)
+                sizes.append(len(s.timers))
+            raise scheduler.ExitScheduler()
+
+        def setter():
+            while True:
+                s.set_flag(flag)
+                yield
+
+        s.run(waiting)
+        s.run(setter)
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        self.assertLessEqual(max(sizes), 3)
+
+
+class Test_scheduler_priorities(unittest.TestCase):
+
+    def test_priority(self):
+        """Runnable tasks with higher priority are served first"""
+        s = TestScheduler()
+        order = []
+
+        def task(name, steps):
+            for i in range(steps):
+                order.append(name)
+                yield
+            if name == 'low':
+                raise scheduler.ExitScheduler()
+
+        s.run(lambda: task('low', 2), priority=-1)
+        s.run(lambda: task('normal', 2))
+        s.run(lambda: task('high', 3), priority=5)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertEqual(order, ['high'] * 3 + ['normal'] * 2 + ['low'] * 2)
+
+    def test_old_task_class(self):
+        """Task subclasses with the __init__ signature of earlier versions still work"""
+        class OldTask(scheduler.Task):
+            def __init__(self, scheduler, generator):
+                super().__init__(scheduler, generator)
+
+        s = TestScheduler()
+        order = []
+
+        def task(name):
+            order.append(name)
+            yield
+            if name == 'normal':
+                raise scheduler.ExitScheduler()
+
+        s.run(lambda: task('normal'))
+        self.assertEqual(s.run(lambda: task('high'), OldTask, priority=1).priority, 1)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertEqual(order, ['high', 'normal'])
+
+    def test_resumed_priority(self):
+        """A resumed task of higher priority preempts a busy lower one"""
+        s = TestScheduler()
+        flag = s.new_flag()
+        order = []
+
+        def high():
+            yield flag
+            order.append('high')
+            raise scheduler.ExitScheduler()
+
+        def busy():
+            for i in range(3):
+                order.append(i)
+                if i == 1:
+                    s.set_flag(flag)
+                yield
+
+        s.run(high, priority=1)
+        s.run(busy)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertEqual(order, [0, 1, 'high'])
+
+    def test_accounting(self):
+        """The time used by the steps of each task is measured"""
+        s = TestScheduler()
+
+        def slow():
+            for i in range(3):
+                time.sleep(0.01)
+                yield
+            raise scheduler.ExitScheduler()
+
+        task = s.run(slow)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertEqual(task.runs, 3)  # the last one exits the loop
+        self.assertGreaterEqual(task.cpu_ms * 1000 + task._cpu_us, 30000)
+        self.assertGreaterEqual(task.max_us, 10000)
+
+    def test_accounting_limit(self):
+        """The counters are halved before they leave the small int range"""
+        s = TestScheduler()
+
+        def busy():
+            while True:
+                yield
+
+        task = s.run(busy)
+        task.runs = scheduler.CLOCK_LIMIT
+        task.cpu_ms = 1000
+        task.overruns = 10
+        s._run_tasks(s.running)
+        self.assertEqual((task.runs, task.cpu_ms, task.overruns), ((scheduler.CLOCK_LIMIT + 1) // 2, 500, 5))
+        task.runs = 100
+        task.cpu_ms = scheduler.CLOCK_LIMIT + 1
+        s._run_tasks(s.running)
+        self.assertEqual((task.runs, task.cpu_ms), (50, scheduler.CLOCK_LIMIT // 2))
+
+    def test_budget(self):
+        """Steps longer than the budget are reported, the task continues"""
+        s = TestScheduler()
+        s.step_budget = 5000
+
+        class TaskWithTrace(scheduler.Task):
+            def handle_exception(self, exception):
+                self.scheduler.trace(type(exception).__name__)
+
+        def slow():
+            yield
+            time.sleep(0.01)
+            yield
+            raise scheduler.ExitScheduler()
+
+        task = s.run(slow, TaskWithTrace)
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertEqual(task.overruns, 1)
+        self.assertEqual(s.get_trace().count('BudgetExceeded'), 1)
+
+
+class Test_scheduler_irq(unittest.TestCase):
+    """Flags set by interrupt handlers"""
+
+    def test_burst(self):
+        """A burst of interrupts wakes the task once, all of them are counted"""
+        s = scheduler.Scheduler()
+        flag = s.new_flag()
+        handler = s.irq_handler(flag)
+        events = []
+
+        def task():
+            while True:
+                yield flag
+                events.append(s.take_events(flag))
+                if sum(events) == 6:
+                    raise scheduler.ExitScheduler()
+
+        def burst(n):
+            for i in range(n):
+                handler()
+
+        s.run(task)
+        threading.Timer(0.1, burst, (5,)).start()
+        threading.Timer(0.2, burst, (1,)).start()
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        # usually [5, 1], the thread may be interrupted within the burst
+        self.assertLessEqual(len(events), 3)
+
+    def test_wrap_around(self):
+        """The counters wrap around without loosing events"""
+        s = scheduler.Scheduler()
+        flag = s.new_flag()
+        handler = s.irq_handler(flag)
+        for i in range(0xffff):
+            handler()
+        self.assertEqual(s.take_events(flag), 0xffff)
+        handler()
+        handler()
+        self.assertEqual(s.take_events(flag), 2)
+
+    def test_too_many_flags(self):
+        """Handlers are only available for the first IRQ_FLAGS flags"""
+        s = scheduler.Scheduler()
+        flags = [s.new_flag() for i in range(scheduler.IRQ_FLAGS + 1)]
+        s.irq_handler(flags[scheduler.IRQ_FLAGS - 1])
+        self.assertRaises(ValueError, s.irq_handler, flags[scheduler.IRQ_FLAGS])
+
+    def test_wakeup(self):
+        """Interrupts from an other thread wake up the sleeping scheduler"""
+        s = scheduler.Scheduler()
+        flag = s.new_flag()
+        handler = s.irq_handler(flag)
+        count = 0
+
+        def task():
+            nonlocal count
+            while count < 50:
+                yield flag
+                count += s.take_events(flag)
+            raise scheduler.ExitScheduler()
+
+        def interrupts():
+            for i in range(50):
+                time.sleep(0.002)
+                handler()
+
+        s.run(task)
+        threading.Thread(target=interrupts).start()
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        self.assertEqual(count, 50)
+
+
+class Test_scheduler_io(unittest.TestCase):
+    """Tasks waiting for sockets, the default sleep() blocks in poll()"""
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.a.setblocking(False)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_readable(self):
+        """A task waiting for a socket is resumed when data arrives, without using the CPU meanwhile"""
+        s = scheduler.Scheduler()
+        stopwatch = Stopwatch()
+        received = []
+
+        def reader():
+            readable = scheduler.Readable(self.a)
+            with stopwatch:
+                yield readable
+            received.append(self.a.recv(10))
+            received.append(readable.events)
+            raise scheduler.ExitScheduler()
+
+        s.run(reader)
+        threading.Timer(0.3, lambda: self.b.send(b'hello')).start()
+        t_cpu = time.process_time()
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        self.assertLess(time.process_time() - t_cpu, 0.1)
+        self.assertTrue(0.29 < stopwatch.elapsed_time < 0.4)
+        self.assertEqual(received, [b'hello', select.POLLIN])
+        self.assertEqual(s.io, {})
+
+    def test_custom_sleep(self):
+        """The loop polls the streams, also with a sleep() that does not know about them"""
+        s = TestScheduler()
+        stopwatch = Stopwatch()
+
+        def reader():
+            with stopwatch:
+                yield scheduler.Readable(self.a)
+            raise scheduler.ExitScheduler()
+
+        s.run(reader)
+        threading.Timer(0.1, lambda: self.b.send(b'hello')).start()
+        self.assertRaises(scheduler.ExitScheduler, s.run_loop)
+        self.assertTrue(0.099 < stopwatch.elapsed_time < 0.2)
+
+    def test_timeout(self):
+        """Waits for streams can time out"""
+        s = scheduler.Scheduler()
+        stopwatch = Stopwatch()
+        readable = scheduler.Readable(self.a, 100)
+
+        def reader():
+            with stopwatch:
+                yield readable
+            raise scheduler.ExitScheduler()
+
+        s.run(reader)
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        self.assertTrue(0.099 < stopwatch.elapsed_time < 0.2)
+        self.assertEqual(readable.events, 0)
+        self.assertEqual(s.io, {})
+
+    def test_writable(self):
+        """Tasks can wait until a stream can be written, others keep running"""
+        s = scheduler.Scheduler()
+        steps = 0
+
+        def writer():
+            writable = scheduler.Writable(self.a)
+            yield writable
+            self.assertEqual(writable.events, select.POLLOUT)
+            raise scheduler.ExitScheduler()
+
+        def busy():
+            nonlocal steps
+            while True:
+                steps += 1
+                yield
+
+        s.run(writer)
+        s.run(busy)
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        self.assertLess(steps, 3)
+
+    def test_poll_interval(self):
+        """While tasks are runnable, streams are only polled every POLL_MS"""
+        s = scheduler.Scheduler()
+        polls = 0
+        steps = 0
+
+        def reader():
+            yield scheduler.Readable(self.a)
+
+        def busy():
+            nonlocal polls, steps
+            poll = s._poll
+
+            def counting_poll(timeout):
+                nonlocal polls
+                polls += 1
+                return poll(timeout)
+
+            s._poll = counting_poll
+            t_end = time.monotonic() + 0.1
+            while time.monotonic() < t_end:
+                steps += 1
+                yield
+            raise scheduler.ExitScheduler()
+
+        s.run(reader)
+        s.run(busy)
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        self.assertLess(polls, 0.1 * 1000 / scheduler.POLL_MS + 3)
+        self.assertGreater(steps, polls * 10)
+
+    def test_ipoll(self):
+        """ipoll() is used when available, it does not allocate a list of results"""
+        class Poller(object):
+            def __init__(self, poll=select.poll):
+                self.poller = poll()
+                self.register = self.poller.register
+                self.unregister = self.poller.unregister
+                self.ipolls = 0
+
+            def ipoll(self, timeout):
+                self.ipolls += 1
+                return iter(self.poller.poll(timeout))
+
+            def poll(self, timeout):
+                raise AssertionError('poll() must not be used')
+
+        s = scheduler.Scheduler()
+        original = scheduler.select.poll
+        scheduler.select.poll = Poller
+        try:
+            def reader():
+                yield scheduler.Readable(self.a)
+                raise scheduler.ExitScheduler()
+
+            s.run(reader)
+            self.b.send(b'x')
+            self.assertRaises(scheduler.ExitScheduler, s.loop)
+        finally:
+            scheduler.select.poll = original
+        self.assertGreater(s.poller.ipolls, 0)
+
+class Test_scheduler_stats(unittest.TestCase):
+
+    def test_stats(self):
+        """Tasks, their counters and wake reasons, loop rate and idle time"""
+        s = scheduler.Scheduler()
+        flag = s.new_flag()
+
+        def sleeper():
+            yield scheduler.Delay(50)
+            yield flag
+            yield flag
+
+        def setter():
+            yield scheduler.Delay(100)
+            s.set_flag(flag)
+            yield
+            s.stats_at_end = s.stats()
+            raise scheduler.ExitScheduler()
+
+        task = s.run(sleeper, priority=1)
+        s.run(setter)
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        stats = s.stats_at_end
+        self.assertEqual(stats['tasks'][0]['name'], 'sleeper')
+        self.assertEqual((task.runs, task.wake, task.mask), (3, 'flag', flag))
+        self.assertEqual(stats['tasks'][0]['state'], 'waiting')
+        self.assertEqual(stats['tasks'][1]['name'], 'setter')
+        self.assertEqual(stats['tasks'][1]['wake'], 'timer')
+        self.assertTrue(95 < stats['elapsed_ms'] < 200)
+        self.assertGreater(stats['idle'], 0.8)
+        self.assertGreater(stats['passes_per_s'], 0)
+        s.stats(reset=True)
+        self.assertEqual((s.passes, s.idle_ms), (0, 0))
+
+    def test_stats_limit(self):
+        """The loop counters are reset before they leave the small int range"""
+        s = scheduler.Scheduler()
+
+        def sleeper():
+            yield scheduler.Delay(5)
+            raise scheduler.ExitScheduler()
+
+        s.run(sleeper)
+        s.passes = scheduler.CLOCK_LIMIT
+        s.idle_ms = scheduler.CLOCK_LIMIT
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        # far below CLOCK_LIMIT, i.e. restarted (the bounds leave room for slow test machines)
+        self.assertLess(s.passes, 1000)
+        self.assertLess(s.idle_ms, 1000)
+        self.assertLess(s.stats()['elapsed_ms'], 1000)
+
+    def test_log(self):
+        """The stats can be written to a ulog.Logger"""
+        class Logger(object):
+            def __init__(self):
+                self.lines = []
+
+            def info(self, message):
+                self.lines.append(message)
+
+        s = scheduler.Scheduler()
+        s.run(lambda: iter(())).name = 'nothing'
+        log = Logger()
+        s.log_stats(log)
+        self.assertEqual(len(log.lines), 2)
+        self.assertTrue(log.lines[1].startswith('nothing prio 0 running mask 0x0: 0 runs'))
+
+
+class Test_scheduler_benchmark(unittest.TestCase):
+    """The cost of a task switch must not grow with the number of tasks"""
+
+    STEPS = 20000
+
+    def measure(self, s):
+        t_start = time.perf_counter()
+        self.assertRaises(scheduler.ExitScheduler, s.loop)
+        return self.STEPS / (time.perf_counter() - t_start)
+
+    def running(self, n_tasks):
+        """task switches per second, with n_tasks that are always ready"""
+        s = scheduler.Scheduler()
+        steps = 0
+
+        def task():
+            nonlocal steps
+            while True:
+                steps += 1
+                if steps == self.STEPS:
+                    raise scheduler.ExitScheduler()
+                yield
+
+        for i in range(n_tasks):
+            s.run(task)
+        return self.measure(s)
+
+    def waiting(self, n_tasks):
+        """wake ups per second, with n_tasks waiting for their own flag"""
+        s = scheduler.Scheduler()
+        flags = [s.new_flag() for i in range(n_tasks)]
+        steps = 0
+
+        def task(flag):
+            nonlocal steps
+            while True:
+                yield flag
+                steps += 1
+                if steps == self.STEPS:
+                    raise scheduler.ExitScheduler()
+
+        def driver():
+            while True:
+                for flag in flags:
+                    s.set_flag(flag)
+                    yield
+
+        for flag in flags:
+            s.run(lambda flag=flag: task(flag))
+        s.run(driver)
+        return self.measure(s)
+
+    def test_running(self):
+        results = [(n, self.running(n)) for n in (1, 10, 100)]
+        print('\nrunning tasks: ' + ', '.join('{}: {:.0f}/s'.format(n, rate) for n, rate in results))
+        self.assertGreater(results[-1][1], results[1][1] * 0.3)
+
+    def test_waiting(self):
+        results = [(n, self.waiting(n)) for n in (5, 30)]
+        print('\nwaiting tasks: ' + ', '.join('{}: {:.0f}/s'.format(n, rate) for n, rate in results))
+        self.assertGreater(results[-1][1], results[0][1] * 0.3)
+
+
 class Test_scheduler_with_interrupts(unittest.TestCase):
 
     class InterruptSimulator(threading.Thread):
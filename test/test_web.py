@@ -0,0 +1,776 @@
+#! /usr/bin/env python3
+"""\
+Tests for the web package.
+"""
+
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import unittest
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(__file__), '../device/flash/lib'))
+from web.app import App
+from web.cache import ResponseCache, add_stats_route
+from web.connection import Connection, GCPolicy
+from web.stats import RequestStats, add_scheduler_route
+from web.request import Request, register_header, MAX_HEADERS, MAX_LINE
+from web import url
+import web.connection
+from web.server import Server, MAX_REQUEST_HEAD, _SocketReader
+from web.response import ChunkedResponse, FileResponse, HtmlResponse, JsonStreamResponse, iterencode, \
+    RedirectResponse, Response, StreamResponse, STATUS200, STATUS404
+
+sys.print_exception = lambda e: traceback.print_tb(e.__traceback__) or print(e)
+
+
+def make_app():
+    app = App()
+
+    @app.route('/')
+    def index(request):
+        return HtmlResponse('Success')
+
+    @app.route('/echo', b'POST')
+    def echo(request):
+        return HtmlResponse(request.raw())
+
+    @app.route('/upload', b'POST')
+    def upload(request):
+        # consume only part of the body, the rest is dropped by cleanup()
+        total = 0
+        for chunk in request.iter_content(4):
+            total += len(chunk)
+            if total >= 8:
+                break
+        return HtmlResponse('got {}'.format(total))
+
+    @app.route('/upper', b'POST')
+    def upper(request):
+        # the body is read while the response is sent
+        return ChunkedResponse((bytes(chunk).upper() for chunk in request.iter_content(4)), b'text/plain')
+
+    @app.route('/redirect')
+    def redirect(request):
+        return RedirectResponse('/')
+
+    @app.route('/ok')
+    def ok(request):
+        return STATUS200
+
+    @app.route('/unknown_length')
+    def unknown_length(request):
+        return Response(b'200 OK')
+
+    @app.route('/count/<int:n>')
+    def count(request, n):
+        return ChunkedResponse(('{},'.format(i) for i in range(n)), b'text/plain')
+
+    @app.route('/readings')
+    def readings(request):
+        return JsonStreamResponse({'readings': ({'index': i, 'value': i / 4} for i in range(300)), 'unit': 'm/s'})
+
+    @app.route('/search')
+    def search(request):
+        return HtmlResponse(repr(sorted(request.query.items())))
+
+    @app.route('/broken')
+    def broken(request):
+        def generate():
+            yield 'start'
+            raise ValueError('test')
+        return ChunkedResponse(generate(), b'text/plain')
+
+    return app
+
+
+def serve(data, app=None, **kwargs):
+    """run a connection on the given input, return the output"""
+    wfile = io.BytesIO()
+    connection = Connection(b'test', io.BytesIO(data), wfile, **kwargs)
+    connection.do_request(app if app is not None else make_app())
+    return wfile.getvalue()
+
+
+class Test_keep_alive(unittest.TestCase):
+
+    def test_close(self):
+        """without keep, only the first request is answered"""
+        out = serve(b'GET / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n')
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 1)
+        self.assertIn(b'Connection: close\r\n', out)
+
+    def test_pipelined(self):
+        """pipelined requests are answered in order, bodies are consumed"""
+        out = serve(b'GET / HTTP/1.1\r\n\r\n'
+                    b'POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+                    b'POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nworld',
+                    keep=True)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 3)
+        self.assertLess(out.index(b'Success'), out.index(b'hello'))
+        self.assertLess(out.index(b'hello'), out.index(b'world'))
+        self.assertEqual(out.count(b'Connection: keep-alive\r\n'), 3)
+
+    def test_client_close(self):
+        """the client can request to close the connection"""
+        out = serve(b'GET / HTTP/1.1\r\nConnection: close\r\n\r\nGET / HTTP/1.1\r\n\r\n', keep=True)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 1)
+        self.assertIn(b'Connection: close\r\n', out)
+
+    def test_http10(self):
+        """HTTP/1.0 clients have to ask for keep-alive"""
+        out = serve(b'GET / HTTP/1.0\r\n\r\nGET / HTTP/1.0\r\n\r\n', keep=True)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 1)
+        out = serve(b'GET / HTTP/1.0\r\nConnection: Keep-Alive\r\n\r\nGET / HTTP/1.0\r\n\r\n', keep=True)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 2)
+
+    def test_max_requests(self):
+        """the connection is closed after max_requests"""
+        out = serve(b'GET / HTTP/1.1\r\n\r\n' * 5, keep=True, max_requests=3)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 3)
+        self.assertEqual(out.count(b'Connection: keep-alive\r\n'), 2)
+
+    def test_bodyless(self):
+        """responses without body have a length, so that the connection can be kept"""
+        out = serve(b'GET /redirect HTTP/1.1\r\n\r\nGET /ok HTTP/1.1\r\n\r\nGET /ok HTTP/1.1\r\n\r\n'
+                    b'GET / HTTP/1.1\r\n\r\n', keep=True)
+        self.assertEqual(out.count(b'HTTP/1.1 302 Moved Temporarily\r\n'), 1)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK\r\n'), 3)
+        self.assertEqual(out.count(b'Content-Length: 0\r\n'), 3)
+        self.assertEqual(out.count(b'Connection: keep-alive\r\n'), 4)
+
+    def test_unknown_length(self):
+        """without length, the end of the body is marked by closing the connection"""
+        for path in (b'/unknown_length', b'/ok', b'/unknown_length'):
+            out = serve(b'GET ' + path + b' HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n', keep=True)
+            self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 1 if path == b'/unknown_length' else 2)
+            self.assertEqual(out.count(b'Connection: close\r\n'), 1 if path == b'/unknown_length' else 0)
+
+    def test_no_request(self):
+        """connections closed by the client without request are no error"""
+        self.assertEqual(serve(b'', keep=True), b'')
+
+
+class Test_body(unittest.TestCase):
+
+    def test_iter_content(self):
+        out = serve(b'POST /upload HTTP/1.1\r\nContent-Length: 10\r\n\r\n0123456789'
+                    b'POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello',
+                    keep=True)
+        self.assertIn(b'got 8', out)
+        self.assertTrue(out.endswith(b'hello'))
+
+    def test_drain_on_close(self):
+        """unread bodies are dropped before closing, up to MAX_DRAIN bytes"""
+        data = b'POST /upload HTTP/1.1\r\nContent-Length: 1000\r\n\r\n' + b'x' * 1000
+        rfile = io.BytesIO(data)
+        Connection(b'test', rfile, io.BytesIO()).do_request(make_app())
+        self.assertEqual(rfile.tell(), len(data))
+        original = web.connection.MAX_DRAIN
+        web.connection.MAX_DRAIN = 100
+        try:
+            rfile = io.BytesIO(data)
+            Connection(b'test', rfile, io.BytesIO()).do_request(make_app())
+        finally:
+            web.connection.MAX_DRAIN = original
+        self.assertLess(rfile.tell(), len(data) - 500)
+
+    def test_lazy_body(self):
+        """the body is not dropped before a streamed response has read it"""
+        out = serve(b'POST /upper HTTP/1.1\r\nContent-Length: 10\r\n\r\nabcdefghij'
+                    b'POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello',
+                    keep=True)
+        head, body = out.split(b'\r\n\r\n', 1)
+        content, rest = dechunk(body)
+        self.assertEqual(content, b'ABCDEFGHIJ')
+        self.assertTrue(rest.endswith(b'hello'))
+
+    def test_iter_content_buffer(self):
+        """the buffer for the chunks is allocated once, or passed by the caller"""
+        connection = Connection(b'test', io.BytesIO(b'0123456789' * 2), io.BytesIO())
+        request = Request(connection)
+        request._remaining = 10
+        first = [chunk.obj for chunk in request.iter_content(4)]
+        request._remaining = 10
+        second = [chunk.obj for chunk in request.iter_content(4)]
+        self.assertEqual(len(first), 3)
+        self.assertTrue(all(obj is first[0] for obj in first + second))
+        buf = bytearray(8)
+        request = Request(Connection(b'test', io.BytesIO(b'hello'), io.BytesIO()))
+        request._remaining = 5
+        self.assertEqual([(bytes(chunk), chunk.obj is buf) for chunk in request.iter_content(buf=buf)],
+                         [(b'hello', True)])
+
+    def test_stream_response(self):
+        for stream in (io.BytesIO(b'x' * 1000), io.BufferedReader(io.BytesIO(b'x' * 1000))):
+            wfile = io.BytesIO()
+            Connection(b'test', None, wfile).send(StreamResponse(stream, 1000, b'text/plain', chunk_size=64))
+            self.assertTrue(wfile.getvalue().endswith(b'\r\n\r\n' + b'x' * 1000))
+
+    def test_stream_response_read(self):
+        """streams without readinto() are supported too"""
+        class Stream(object):
+            def __init__(self):
+                self.data = io.BytesIO(b'abc' * 100)
+                self.read = self.data.read
+                self.close = self.data.close
+        wfile = io.BytesIO()
+        Connection(b'test', None, wfile).send(StreamResponse(Stream(), 300, b'text/plain'))
+        self.assertTrue(wfile.getvalue().endswith(b'\r\n\r\n' + b'abc' * 100))
+
+
+def dechunk(data):
+    """decode chunked transfer encoding, return the content and the rest of the data"""
+    content = []
+    while True:
+        size, data = data.split(b'\r\n', 1)
+        size = int(size, 16)
+        if not size:
+            assert data.startswith(b'\r\n')
+            return b''.join(content), data[2:]
+        content.append(data[:size])
+        assert data[size:size + 2] == b'\r\n'
+        data = data[size + 2:]
+
+
+class Test_headers(unittest.TestCase):
+
+    def read(self, data):
+        request = Request(Connection(b'test', io.BytesIO(data), None))
+        request._read_request()
+        return request.headers
+
+    def test_case(self):
+        """wanted headers are found in any case, stored with the registered name"""
+        headers = self.read(b'POST / HTTP/1.1\r\ncontent-LENGTH:  5 \r\nX-Other: 1\r\nHost: x\r\n\r\n')
+        self.assertEqual(headers, {b'Content-Length': b'5'})
+
+    def test_register(self):
+        register_header(b'X-Token')
+        self.assertEqual(self.read(b'GET / HTTP/1.1\r\nx-token: secret\r\n\r\n'), {b'X-Token': b'secret'})
+
+    def test_limits(self):
+        out = serve(b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * (MAX_HEADERS + 1) + b'\r\n', keep=True)
+        self.assertTrue(out.startswith(b'HTTP/1.1 431 '))
+        self.assertIn(b'Connection: close\r\n', out)
+        out = serve(b'GET / HTTP/1.1\r\nX: ' + b'y' * MAX_LINE + b'\r\n\r\n')
+        self.assertTrue(out.startswith(b'HTTP/1.1 431 '))
+        out = serve(b'GET / HTTP/1.1\r\n' + b'X: y\r\n' * MAX_HEADERS + b'\r\n')
+        self.assertTrue(out.startswith(b'HTTP/1.1 200 OK'))
+
+    def test_bad_request(self):
+        for data in (b'GET\r\n\r\n', b'GET / HTTP/1.1\r\nno colon\r\n\r\n',
+                     b'POST /echo HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                     b'POST /echo HTTP/1.1\r\nContent-Length: -5\r\n\r\nGET / HTTP/1.1\r\n\r\n'):
+            out = serve(data, keep=True)
+            self.assertTrue(out.startswith(b'HTTP/1.1 400 '))
+            self.assertEqual(out.count(b'HTTP/1.1 '), 1)
+
+
+class Test_hooks(unittest.TestCase):
+
+    def test_hooks(self):
+        app = make_app()
+        calls = []
+        app.before_request(lambda request: calls.append(('before', request.path)))
+        app.after_request(lambda request, response, connection: calls.append(
+            ('after', response.status, connection.response_bytes)))
+
+        @app.before_request
+        def deny(request):
+            if request.path == b'/secret':
+                return STATUS404
+
+        out = serve(b'GET / HTTP/1.1\r\n\r\nGET /secret HTTP/1.1\r\n\r\n', keep=True, app=app)
+        self.assertEqual(calls, [('before', b'/'), ('after', b'200 OK', out.index(b'HTTP/1.1 404')),
+                                 ('before', b'/secret'), ('after', b'404 Not Found', len(out) - out.index(b'HTTP/1.1 404'))])
+
+    def test_stats(self):
+        app = make_app()
+        stats = RequestStats(size=2).install(app)
+        out = serve(b'GET / HTTP/1.1\r\n\r\n' * 3 + b'GET /_stats HTTP/1.1\r\n\r\n', keep=True, app=app)
+        result = json.loads(out.rsplit(b'\r\n\r\n', 1)[1].decode('utf-8'))
+        self.assertEqual(result['requests'], 3)
+        self.assertEqual([(e['path'], e['status']) for e in result['recent']], [('/', '200 OK')] * 2)
+        self.assertGreater(result['recent'][0]['bytes'], 7)
+        self.assertIn('runs', result['gc'])
+        self.assertEqual(stats.count, 4)
+
+    def test_stats_short_circuit(self):
+        """requests answered by an earlier before-hook are not recorded"""
+        app = make_app()
+
+        @app.before_request
+        def deny(request):
+            if request.path == b'/secret':
+                return STATUS404
+
+        stats = RequestStats().install(app)
+        serve(b'GET / HTTP/1.1\r\n\r\nGET /secret HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n', keep=True, app=app)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual([e['path'] for e in stats.recent()], ['/', '/'])
+
+    def test_scheduler_stats(self):
+        import scheduler
+        s = scheduler.Scheduler()
+        s.run(lambda: iter(())).name = 'idle'
+        app = make_app()
+        add_scheduler_route(app, s)
+        out = serve(b'GET /_tasks?reset=1 HTTP/1.1\r\n\r\n', app=app)
+        result = json.loads(out.rsplit(b'\r\n\r\n', 1)[1].decode('utf-8'))
+        self.assertEqual([(t['name'], t['state'], t['runs']) for t in result['tasks']], [('idle', 'running', 0)])
+        self.assertEqual(s.passes, 0)
+
+    def test_gc_policy(self):
+        policy = GCPolicy()
+        policy()
+        self.assertEqual((policy.runs, policy.skipped), (1, 0))
+        # CPython has no gc.mem_free()
+        import gc
+        gc.mem_free = lambda: 10000
+        try:
+            policy.min_free = 8192
+            policy()
+            policy.min_free = 20000
+            policy()
+        finally:
+            del gc.mem_free
+        self.assertEqual((policy.runs, policy.skipped), (2, 1))
+
+
+class Test_chunked(unittest.TestCase):
+
+    def test_chunked(self):
+        out = serve(b'GET /count/1000 HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n', keep=True)
+        head, body = out.split(b'\r\n\r\n', 1)
+        self.assertIn(b'Transfer-Encoding: chunked\r\n', head)
+        self.assertNotIn(b'Content-Length', head)
+        content, rest = dechunk(body)
+        self.assertEqual(content, ''.join('{},'.format(i) for i in range(1000)).encode('utf-8'))
+        # the connection is usable for the next request
+        self.assertTrue(rest.startswith(b'HTTP/1.1 200 OK'))
+
+    def test_http10(self):
+        """HTTP/1.0 clients get the plain data, end marked by closing the connection"""
+        out = serve(b'GET /count/10 HTTP/1.0\r\nConnection: keep-alive\r\n\r\nGET / HTTP/1.0\r\n\r\n', keep=True)
+        head, body = out.split(b'\r\n\r\n', 1)
+        self.assertNotIn(b'Transfer-Encoding', head)
+        self.assertTrue(head.endswith(b'Connection: close'))
+        self.assertEqual(body, b'0,1,2,3,4,5,6,7,8,9,')
+
+    def test_json(self):
+        out = serve(b'GET /readings HTTP/1.1\r\n\r\n')
+        head, body = out.split(b'\r\n\r\n', 1)
+        self.assertIn(b'Content-Type: application/json\r\n', head)
+        content, rest = dechunk(body)
+        self.assertEqual(json.loads(content.decode('utf-8')), {
+            'readings': [{'index': i, 'value': i / 4} for i in range(300)],
+            'unit': 'm/s'})
+        # small pieces are combined to chunks of up to 256 bytes
+        sizes = []
+        while not body.startswith(b'0\r\n'):
+            size, body = body.split(b'\r\n', 1)
+            sizes.append(int(size, 16))
+            body = body[sizes[-1] + 2:]
+        self.assertLessEqual(max(sizes), 256)
+        self.assertLess(len(sizes), len(content) // 200)
+
+    def test_iterencode(self):
+        for obj in ([], {}, [1, [2, [3]], {'a': None}], {'x"y': ['\u00e4\n', True, False, 1.5]}, 'text', 42):
+            self.assertEqual(json.loads(''.join(iterencode(obj))), obj)
+
+    def test_error(self):
+        """errors in the generator close the connection without the last chunk"""
+        out = serve(b'GET /broken HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n', keep=True)
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 1)
+        self.assertTrue(out.endswith(b'5\r\nstart\r\n'))
+
+
+class Test_writes(unittest.TestCase):
+
+    def send(self, response, keep=False):
+        wfile = io.BytesIO()
+        connection = Connection(b'test', None, wfile, keep=keep)
+        connection.send(response)
+        return wfile.getvalue(), connection.response_writes
+
+    def test_small(self):
+        """head and small body are sent with one write"""
+        out, writes = self.send(HtmlResponse('Success'))
+        self.assertEqual(writes, 1)
+        self.assertTrue(out.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(out.endswith(b'\r\n\r\nSuccess'))
+
+    def test_constant(self):
+        """the head of constant responses is cached per connection state"""
+        out_close, writes = self.send(STATUS404)
+        self.assertEqual(writes, 1)
+        self.assertEqual(self.send(STATUS404)[0], out_close)
+        out_keep, writes = self.send(STATUS404, keep=True)
+        self.assertEqual(writes, 1)
+        self.assertIn(b'Connection: keep-alive\r\n', out_keep)
+        self.assertIn(b'Connection: close\r\n', out_close)
+        self.assertEqual(set(STATUS404.heads), {True, False})
+
+    def test_large(self):
+        """large bodies are written directly"""
+        out, writes = self.send(HtmlResponse(b'x' * 2000))
+        self.assertEqual(writes, 2)
+        self.assertTrue(out.endswith(b'\r\n\r\n' + b'x' * 2000))
+        out, writes = self.send(StreamResponse(io.BytesIO(b'x' * 1000), 1000, b'text/plain', chunk_size=256))
+        self.assertEqual(writes, 3)
+        self.assertTrue(out.endswith(b'\r\n\r\n' + b'x' * 1000))
+
+
+class Test_url(unittest.TestCase):
+
+    def test_decode(self):
+        self.assertEqual(url.decode(b'/plain/path'), '/plain/path')
+        self.assertEqual(url.decode(b'/a%20b%2Fc'), '/a b/c')
+        self.assertEqual(url.decode(b'%C3%A4%c3%b6'), '\u00e4\u00f6')
+        self.assertEqual(url.decode(b'a+b'), 'a+b')
+        self.assertEqual(url.decode(b'a+b%2B', plus=True), 'a b+')
+        self.assertEqual(url.decode(b'100%'), '100%')
+        self.assertEqual(url.decode(b'%zz%4'), '%zz%4')
+
+    def test_decode_invalid(self):
+        # only two hex digits form an escape, int() would also accept these
+        for b_url in (b'% f', b'%+1', b'%-0', b'%0x', b'%_1', b'% 1%'):
+            self.assertEqual(url.decode(b_url), b_url.decode('utf-8'))
+        self.assertEqual(url.decode(b'a%+1b', plus=True), 'a% 1b')
+        self.assertEqual(url.decode(b'%%41%'), '%A%')
+        self.assertEqual(url.decode(b'%4a%4A%2f%2F%09'), 'JJ//\t')
+
+    def test_split(self):
+        self.assertEqual(url.split(b'/path'), (b'/path', None))
+        self.assertEqual(url.split(b'/path?'), (b'/path', b''))
+        self.assertEqual(url.split(b'/p?a=1?b'), (b'/p', b'a=1?b'))
+
+    def test_query(self):
+        self.assertEqual(url.parse_query(None), {})
+        self.assertEqual(url.parse_query(b'a=1&b=x+y&&c&a=%26'), {'a': '&', 'b': 'x y', 'c': ''})
+
+    def test_request(self):
+        out = serve(b'GET /search?q=caf%C3%A9&n=2 HTTP/1.1\r\n\r\n')
+        self.assertTrue(out.endswith(repr([('n', '2'), ('q', 'caf\u00e9')]).encode('utf-8')))
+
+
+class FakeRequest(object):
+    def __init__(self, method=b'GET', headers=None, path=None):
+        self.method = method
+        self.headers = headers if headers is not None else {}
+        self.path = path
+
+
+class Test_cache(unittest.TestCase):
+
+    def test_stats_without_cache(self):
+        """the statistics can be served before any route with ttl is added"""
+        app = App()
+        add_stats_route(app)
+        stats = json.loads(app.handle_request(FakeRequest(path='/_cache'), '/_cache').content.decode('utf-8'))
+        self.assertEqual((stats['entries'], stats['hits']), (0, 0))
+
+        @app.route('/value', ttl=1)
+        def value(request):
+            return HtmlResponse('value')
+
+        app.handle_request(FakeRequest(path='/value'), '/value')
+        stats = json.loads(app.handle_request(FakeRequest(path='/_cache'), '/_cache').content.decode('utf-8'))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_route(self):
+        app = App()
+        calls = []
+
+        @app.route('/value/<int:n>', ttl=0.2)
+        def value(request, n):
+            calls.append(n)
+            return HtmlResponse('value {}'.format(n))
+
+        add_stats_route(app)
+
+        def get(path):
+            return app.handle_request(FakeRequest(path=path), path)
+
+        self.assertEqual(get('/value/1').content, b'value 1')
+        self.assertEqual(get('/value/1').content, b'value 1')
+        self.assertEqual(get('/value/2').content, b'value 2')
+        self.assertEqual(calls, [1, 2])
+        stats = json.loads(get('/_cache').content.decode('utf-8'))
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 2, 2))
+        time.sleep(0.25)
+        get('/value/1')
+        self.assertEqual(calls, [1, 2, 1])
+
+    def test_budget(self):
+        """least recently used entries are removed to stay within the limit"""
+        cache = ResponseCache(max_bytes=1000)
+        for i in range(5):
+            cache.put((b'GET', str(i)), HtmlResponse('x' * 200), ttl=10)
+            self.assertLessEqual(cache.size, 1000)
+        self.assertEqual(sorted(cache.entries), [(b'GET', '2'), (b'GET', '3'), (b'GET', '4')])
+        cache.get((b'GET', '2'))
+        cache.put((b'GET', '5'), HtmlResponse('x' * 200), ttl=10)
+        self.assertEqual(sorted(cache.entries), [(b'GET', '2'), (b'GET', '4'), (b'GET', '5')])
+        self.assertEqual(cache.evictions, 3)
+        # too large and not buffered responses are not stored
+        cache.put((b'GET', 'big'), HtmlResponse('x' * 1000), ttl=10)
+        cache.put((b'GET', 'stream'), StreamResponse(io.BytesIO(), 0, b'text/plain'), ttl=10)
+        self.assertEqual(len(cache.entries), 3)
+
+
+class Test_router(unittest.TestCase):
+
+    def setUp(self):
+        self.app = App()
+        app = self.app
+        app.add_route(b'GET', '/', lambda request: 'index')
+        app.add_route(b'GET', '/favicon.ico', lambda request: 'icon')
+        app.add_route(b'GET', '/thing/(.*)', lambda request, t: ('thing', t))
+        app.add_route(b'GET', '/thing/special', lambda request: 'special')
+        app.add_route(b'GET', '/item/<int:number>', lambda request, n: ('item', n))
+        app.add_route(b'GET', '/item/<name>', lambda request, n: ('name', n))
+        app.add_route(b'GET', '/user/<str:name>/(a|b)(c?)', lambda request, *args: args)
+        app.add_route(b'GET', '/files/<path:rest>', lambda request, rest: ('files', rest))
+        app.add_route(b'POST', '/thing/post', lambda request: 'post')
+
+    def get(self, path, method=b'GET'):
+        return self.app.handle_request(FakeRequest(method), path)
+
+    def test_static(self):
+        self.assertEqual(self.get('/'), 'index')
+        self.assertEqual(self.get('/favicon.ico'), 'icon')
+        self.assertIs(self.get('/favicon_ico'), STATUS404)
+
+    def test_static_before_regexp(self):
+        self.assertEqual(self.get('/thing/special'), 'special')
+        self.assertEqual(self.get('/thing/other/x'), ('thing', 'other/x'))
+        self.assertEqual(self.get('/thing/'), ('thing', ''))
+
+    def test_methods(self):
+        self.assertEqual(self.get('/thing/post', b'POST'), 'post')
+        self.assertEqual(self.get('/thing/post'), ('thing', 'post'))
+        self.assertIs(self.get('/', b'POST'), STATUS404)
+
+    def test_typed(self):
+        self.assertEqual(self.get('/item/42'), ('item', 42))
+        self.assertEqual(self.get('/item/foo'), ('name', 'foo'))
+        self.assertIs(self.get('/item/'), STATUS404)
+        self.assertEqual(self.get('/user/x/bc'), ('x', 'b', 'c'))
+        self.assertEqual(self.get('/user/x/a'), ('x', 'a', ''))
+        self.assertEqual(self.get('/files/a/b.txt'), ('files', 'a/b.txt'))
+
+    def test_mount(self):
+        sub = App()
+        sub.add_route(b'GET', '/', lambda request: 'sub index')
+        sub.add_route(b'GET', '/<int:n>', lambda request, n: ('sub', n))
+        self.app.mount('/sub', sub)
+        self.assertEqual(self.get('/sub'), 'sub index')
+        self.assertEqual(self.get('/sub/'), 'sub index')
+        self.assertEqual(self.get('/sub/7'), ('sub', 7))
+        self.assertIs(self.get('/sub/x'), STATUS404)
+
+
+class Test_file_response(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'style.css')
+        with open(self.path, 'wb') as f:
+            f.write(b'body {}')
+        with gzip.open(self.path + '.gz', 'wb') as f:
+            f.write(b'body {}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def emit(self, response):
+        wfile = io.BytesIO()
+        Connection(b'test', None, wfile).send(response)
+        return wfile.getvalue()
+
+    def test_plain(self):
+        response = FileResponse(self.path, FakeRequest())
+        self.assertEqual(response.headers[b'Content-Type'], b'text/css')
+        self.assertNotIn(b'Content-Encoding', response.headers)
+        self.assertEqual(response.headers[b'Cache-Control'], b'max-age=30')
+        self.assertTrue(self.emit(response).endswith(b'\r\n\r\nbody {}'))
+
+    def test_gzip(self):
+        response = FileResponse(self.path, FakeRequest(headers={b'Accept-Encoding': b'gzip, deflate'}))
+        self.assertEqual(response.headers[b'Content-Encoding'], b'gzip')
+        self.assertEqual(response.headers[b'Content-Type'], b'text/css')
+        self.assertEqual(gzip.decompress(self.emit(response).split(b'\r\n\r\n', 1)[1]), b'body {}')
+        # only the compressed file is present
+        os.remove(self.path)
+        self.assertEqual(FileResponse(self.path).headers[b'Content-Encoding'], b'gzip')
+        os.remove(self.path + '.gz')
+        self.assertIs(FileResponse(self.path), STATUS404)
+
+    def test_conditional(self):
+        response = FileResponse(self.path, FakeRequest())
+        etag = response.headers[b'ETag']
+        last_modified = response.headers[b'Last-Modified']
+        response.stream.close()
+        response = FileResponse(self.path, FakeRequest(headers={b'If-None-Match': etag}))
+        self.assertEqual(response.status, b'304 Not Modified')
+        self.assertEqual(response.headers[b'ETag'], etag)
+        response = FileResponse(self.path, FakeRequest(headers={b'If-Modified-Since': last_modified}))
+        self.assertEqual(response.status, b'304 Not Modified')
+        response = FileResponse(self.path, FakeRequest(headers={b'If-None-Match': b'"other"'}))
+        self.assertEqual(response.status, b'200 OK')
+        response.stream.close()
+        # the compressed variant has a different ETag
+        response = FileResponse(self.path, FakeRequest(headers={b'If-None-Match': etag, b'Accept-Encoding': b'gzip'}))
+        self.assertEqual(response.status, b'200 OK')
+        response.stream.close()
+
+
+class Test_socket_reader(unittest.TestCase):
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_readline(self):
+        self.b.sendall(b'ne 2\r\nrest')
+        self.b.close()
+        reader = _SocketReader(self.a, b'line 1\r\nli')
+        self.assertEqual(reader.readline(), b'line 1\r\n')
+        self.assertEqual(reader.readline(), b'line 2\r\n')
+        self.assertEqual(reader.readline(), b'rest')
+        self.assertEqual(reader.readline(), b'')
+
+    def test_readline_limit(self):
+        self.b.sendall(b'a long line\r\n')
+        reader = _SocketReader(self.a, b'')
+        self.assertEqual(reader.readline(6), b'a long')
+        self.assertEqual(reader.readline(), b' line\r\n')
+
+    def test_read(self):
+        self.b.sendall(b'6789')
+        reader = _SocketReader(self.a, b'012345')
+        self.assertEqual(reader.read(3), b'012')
+        self.assertEqual(reader.read(7), b'3456789')
+
+    def test_readinto(self):
+        self.b.sendall(b'efgh')
+        reader = _SocketReader(self.a, b'abcd')
+        buf = bytearray(6)
+        # buffered data first, then directly from the socket
+        self.assertEqual(reader.readinto(buf), 4)
+        self.assertEqual(buf[:4], b'abcd')
+        self.assertEqual(reader.readinto(memoryview(buf)[:2]), 2)
+        self.assertEqual(buf[:2], b'ef')
+
+
+class Test_server(unittest.TestCase):
+    """Server.start(), clients served as tasks of a scheduler"""
+
+    def setUp(self):
+        import scheduler
+        self.scheduler = scheduler.Scheduler()
+        self.server = Server(make_app(), port=0, backlog=4, idle_timeout=1)
+        self.server.start(self.scheduler)
+        self.thread = threading.Thread(target=self.run_scheduler)
+        self.thread.start()
+
+    def run_scheduler(self):
+        import scheduler
+        try:
+            self.scheduler.loop()
+        except scheduler.ExitScheduler:
+            pass
+
+    def tearDown(self):
+        import scheduler
+
+        def stop():
+            raise scheduler.ExitScheduler()
+            yield
+
+        self.scheduler.run(stop)
+        self.thread.join(2)
+        self.server.listening_socket.close()
+
+    def request(self, data):
+        """send data, return everything received until the server closes the connection"""
+        client = socket.create_connection(('127.0.0.1', self.server.listening_socket.getsockname()[1]))
+        client.sendall(data)
+        out = b''
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            out += chunk
+        client.close()
+        return out
+
+    def test_keep_alive(self):
+        out = self.request(b'GET / HTTP/1.1\r\n\r\nPOST /echo HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+                           b'GET / HTTP/1.1\r\nConnection: close\r\n\r\n')
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 3)
+        self.assertEqual(out.count(b'Connection: keep-alive\r\n'), 2)
+        self.assertIn(b'abc', out)
+
+    def test_keep_alive_redirect(self):
+        """a client reading responses by their length does not wait for the idle timeout"""
+        import http.client
+        client = http.client.HTTPConnection('127.0.0.1', self.server.listening_socket.getsockname()[1], timeout=5)
+        t_start = time.time()
+        for path in ('/redirect', '/ok', '/'):
+            client.request('GET', path)
+            response = client.getresponse()
+            response.read()
+            self.assertFalse(response.will_close)
+        client.close()
+        self.assertLess(time.time() - t_start, 0.5)
+
+    def test_concurrent(self):
+        """an idle client does not block others"""
+        idle = socket.create_connection(('127.0.0.1', self.server.listening_socket.getsockname()[1]))
+        idle.sendall(b'GET / HTTP/1.1\r\n')
+        t_start = time.time()
+        out = self.request(b'GET / HTTP/1.0\r\n\r\n')
+        self.assertLess(time.time() - t_start, 0.5)
+        self.assertTrue(out.startswith(b'HTTP/1.1 200 OK'))
+        idle.close()
+
+    def test_blocking_default(self):
+        """without scheduler, connections are closed by default, as one client is served at a time"""
+        server = Server(make_app(), port=0)
+        thread = threading.Thread(target=server.wait_for_client)
+        thread.start()
+        client = socket.create_connection(('127.0.0.1', server.listening_socket.getsockname()[1]))
+        client.sendall(b'GET / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\n\r\n')
+        out = b''
+        while True:
+            chunk = client.recv(1024)
+            if not chunk:
+                break
+            out += chunk
+        client.close()
+        thread.join(2)
+        server.listening_socket.close()
+        self.assertEqual(out.count(b'HTTP/1.1 200 OK'), 1)
+        self.assertIn(b'Connection: close\r\n', out)
+
+    def test_head_too_large(self):
+        out = self.request(b'GET / HTTP/1.1\r\n' + b'X-Filler: 12345678\r\n' * (MAX_REQUEST_HEAD // 20 + 1))
+        self.assertTrue(out.startswith(b'HTTP/1.1 431 '))
+
+
+if __name__ == '__main__':
+    unittest.main()
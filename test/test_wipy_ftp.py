@@ -0,0 +1,294 @@
+#! /usr/bin/env python3
+"""\
+Tests for wipy-ftp.py, using the simulator and a fake FTP session.
+"""
+
+import contextlib
+import ftplib
+import glob
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+test_root = os.path.dirname(os.path.abspath(__file__))
+
+# the name of the tool is not a valid module name
+_spec = importlib.util.spec_from_file_location('wipy_ftp', os.path.join(test_root, '..', 'wipy-ftp.py'))
+wipy_ftp = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(wipy_ftp)
+
+
+class FakeFTP(object):
+    """\
+    Minimal ftplib.FTP replacement, serving a dict of remote name -> bytes.
+    Like the WiPy, it does not support MLSD and LIST ignores its argument.
+    """
+    def __init__(self, files, fail=()):
+        self.files = dict(files)
+        self.dirs = {'/'}
+        for name in self.files:
+            while name != '/':
+                name = os.path.dirname(name)
+                self.dirs.add(name)
+        self.fail = fail
+        self.cwd_path = '/'
+        self.commands = []
+
+    def _path(self, name):
+        return os.path.normpath(os.path.join(self.cwd_path, name))
+
+    def mlsd(self, path, facts):
+        raise ftplib.error_perm('502 command not implemented')
+
+    def retrlines(self, command, callback):
+        self.commands.append(command)
+        for name in sorted(self.dirs | set(self.files)):
+            if name != '/' and os.path.dirname(name) == self.cwd_path:
+                if name in self.dirs:
+                    callback('drw-rw-rw-   1 root  root         0 Jan  1  1980 ' + os.path.basename(name))
+                else:
+                    callback('-rw-rw-rw-   1 root  root  {:8} Jan  1  1980 {}'.format(
+                        len(self.files[name]), os.path.basename(name)))
+
+    def retrbinary(self, command, callback, blocksize):
+        name = self._path(command.split(' ', 1)[1])
+        data = self.files[name]
+        callback(data[:1])
+        if name in self.fail:
+            raise ftplib.error_temp('421 connection lost')
+        callback(data[1:])
+
+    def cwd(self, path):
+        path = self._path(path)
+        if path not in self.dirs:
+            raise ftplib.error_perm('550 no such directory')
+        self.cwd_path = path
+
+    def pwd(self):
+        return self.cwd_path
+
+    def mkd(self, path):
+        self.dirs.add(self._path(path))
+
+    def close(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+def fake_target(files, fail=()):
+    target = wipy_ftp.WiPyFTP(config=wipy_ftp.read_config(None))
+    target.ftp = FakeFTP(files, fail)
+    target._connect = lambda: target.ftp
+    return target
+
+
+class Test_WiPyFTP(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failed_download(self):
+        """Failed downloads leave no partial files"""
+        target = fake_target({'/flash/a.txt': b'hello', '/flash/b.txt': b'world'}, fail=('/flash/b.txt',))
+        target.retries = 0
+        jobs = [(name, os.path.join(self.directory, name[7:])) for name in ('/flash/a.txt', '/flash/b.txt')]
+        self.assertEqual(target.get_files(jobs), ['/flash/a.txt'])
+        self.assertEqual(os.listdir(self.directory), ['a.txt'])
+
+    def test_walk_list(self):
+        """Without MLSD, directories are listed with cwd and LIST"""
+        target = fake_target({'/flash/main.py': b'x', '/flash/lib/a.py': b'yz', '/flash/lib/web/b.py': b''})
+        tree = list(target.walk('/flash'))
+        self.assertEqual(tree, [
+            ('/flash', ['lib'], ['main.py']),
+            ('/flash/lib', ['web'], ['a.py']),
+            ('/flash/lib/web', [], ['b.py'])])
+        self.assertFalse(target._use_mlsd)
+        self.assertEqual(target.stat('/flash/lib/a.py').size, 2)
+
+    def test_makedirs(self):
+        """The cached listing of the parent directory is updated"""
+        target = fake_target({'/flash/main.py': b'x'})
+        self.assertIsNone(target.stat('/sd'))
+        target.makedirs('/sd/lib')
+        self.assertTrue(target.stat('/sd').is_dir)
+        self.assertTrue(target.stat('/sd/lib').is_dir)
+
+
+class Test_backup(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_board(self, name, n_files):
+        root = os.path.join(self.directory, name)
+        os.makedirs(os.path.join(root, 'flash', 'lib'))
+        contents = {}
+        for i in range(n_files):
+            remote_name = '/flash/lib/file{}.py'.format(i)
+            contents[remote_name] = '{} {}'.format(name, i).encode('utf-8')
+            with open(os.path.join(root, remote_name[1:]), 'wb') as f:
+                f.write(contents[remote_name])
+        return wipy_ftp.WiPySimulator(root), contents
+
+    def test_parallel(self):
+        """Boards backed up at the same time do not mix up their files"""
+        store_dir = os.path.join(self.directory, 'backups')
+        boards = [self.make_board(name, 20) for name in ('a', 'b')]
+        snapshots = {}
+
+        def backup(target):
+            snapshots[target.name] = wipy_ftp.WiPyActions(target, backup_dir=store_dir).backup()
+
+        threads = [threading.Thread(target=backup, args=(target,)) for target, contents in boards]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        store = wipy_ftp.BackupStore(store_dir)
+        for target, contents in boards:
+            files = store.load_snapshot(target.name, snapshots[target.name])
+            self.assertEqual(sorted(files), sorted(contents))
+            for remote_name, entry in files.items():
+                with open(store.blob_path(entry['sha1']), 'rb') as f:
+                    self.assertEqual(f.read(), contents[remote_name])
+            # no temporary files are left behind
+            self.assertEqual(os.listdir(os.path.join(store.tmp, target.name)), [])
+
+    def test_collect_garbage_race(self):
+        """Snapshots removed while the garbage is collected (other boards pruned) are skipped"""
+        store_dir = os.path.join(self.directory, 'backups')
+        target, contents = self.make_board('a', 3)
+        actions = wipy_ftp.WiPyActions(target, backup_dir=store_dir)
+        actions.backup()
+
+        class RacingStore(wipy_ftp.BackupStore):
+            def snapshots(self, target_name):
+                # listed, but removed before it is loaded
+                return super().snapshots(target_name) + ['0000-vanished']
+
+        store = RacingStore(store_dir)
+        os.makedirs(os.path.dirname(store.blob_path('00unreferenced')), exist_ok=True)
+        with open(store.blob_path('00unreferenced'), 'wb'):
+            pass
+        self.assertEqual(store.collect_garbage(), 1)
+        self.assertEqual(len(glob.glob(os.path.join(store_dir, 'blobs', '*', '*'))), 3)
+
+
+class Test_sync(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self._manifest_dir = wipy_ftp.MANIFEST_DIR
+        wipy_ftp.MANIFEST_DIR = os.path.join(self.directory, 'manifests')
+        os.mkdir(os.path.join(self.directory, 'board'))
+        self.target = wipy_ftp.WiPySimulator(os.path.join(self.directory, 'board'))
+        self.files = {}
+
+    def tearDown(self):
+        wipy_ftp.MANIFEST_DIR = self._manifest_dir
+        shutil.rmtree(self.directory)
+
+    def local(self, remote_name, content):
+        """create a local file that is to be installed as remote_name"""
+        local_name = os.path.join(self.directory, 'src', remote_name[1:])
+        os.makedirs(os.path.dirname(local_name), exist_ok=True)
+        with open(local_name, 'wb') as f:
+            f.write(content)
+        self.files[remote_name] = local_name
+
+    def remote(self, remote_name):
+        """content of a file on the target, None if it is missing"""
+        try:
+            with open(os.path.join(self.target.root, remote_name[1:]), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def sync(self, scope='/flash/lib', recursive=True, **kwargs):
+        return wipy_ftp.WiPyActions(self.target, **kwargs).sync(self.files, scope, recursive)
+
+    def test_sync(self):
+        """Only added and modified files are uploaded, files no longer present are removed"""
+        self.local('/flash/lib/a.py', b'a')
+        self.local('/flash/lib/b.py', b'b')
+        self.local('/flash/lib/sub/c.py', b'c')
+        self.assertEqual(self.sync(), [('+', '/flash/lib/a.py'), ('+', '/flash/lib/b.py'), ('+', '/flash/lib/sub/c.py')])
+        self.assertEqual(self.remote('/flash/lib/sub/c.py'), b'c')
+        self.assertEqual(self.sync(), [])
+        self.local('/flash/lib/b.py', b'b2')
+        self.local('/flash/lib/d.py', b'd')
+        del self.files['/flash/lib/sub/c.py']
+        self.assertEqual(self.sync(), [('M', '/flash/lib/b.py'), ('+', '/flash/lib/d.py'), ('-', '/flash/lib/sub/c.py')])
+        self.assertEqual(self.remote('/flash/lib/b.py'), b'b2')
+        self.assertEqual(self.remote('/flash/lib/d.py'), b'd')
+        self.assertIsNone(self.remote('/flash/lib/sub/c.py'))
+        self.assertEqual(self.sync(), [])
+
+    def test_dry_run(self):
+        """With dry_run, the changes are printed, nothing is transferred"""
+        self.local('/flash/lib/a.py', b'a')
+        self.sync()
+        self.local('/flash/lib/a.py', b'a2')
+        self.local('/flash/lib/b.py', b'b')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            changes = self.sync(dry_run=True)
+        self.assertEqual(changes, [('M', '/flash/lib/a.py'), ('+', '/flash/lib/b.py')])
+        self.assertEqual(output.getvalue(), 'M /flash/lib/a.py\n+ /flash/lib/b.py\n')
+        self.assertEqual(self.remote('/flash/lib/a.py'), b'a')
+        self.assertIsNone(self.remote('/flash/lib/b.py'))
+        # the manifest is unchanged too
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.sync(dry_run=True), changes)
+
+    def test_scope(self):
+        """Without recursive, only removals directly in scope are done"""
+        self.local('/flash/boot.py', b'boot')
+        self.local('/flash/main.py', b'main')
+        self.local('/flash/lib/a.py', b'a')
+        self.sync(scope='/flash')
+        del self.files['/flash/main.py']
+        del self.files['/flash/lib/a.py']
+        self.assertEqual(self.sync(scope='/flash', recursive=False), [('-', '/flash/main.py')])
+        self.assertEqual(self.remote('/flash/lib/a.py'), b'a')
+
+    def test_target_changed(self):
+        """Files missing on the target or with a different size are uploaded again"""
+        self.local('/flash/lib/a.py', b'a')
+        self.local('/flash/lib/b.py', b'b')
+        self.local('/flash/lib/c.py', b'c')
+        self.sync()
+        os.remove(os.path.join(self.target.root, 'flash', 'lib', 'a.py'))
+        with open(os.path.join(self.target.root, 'flash', 'lib', 'b.py'), 'wb') as f:
+            f.write(b'truncated in the middle of an upload')
+        self.assertEqual(self.sync(), [('+', '/flash/lib/a.py'), ('M', '/flash/lib/b.py')])
+        self.assertEqual((self.remote('/flash/lib/a.py'), self.remote('/flash/lib/b.py')), (b'a', b'b'))
+
+    def test_remote_manifest(self):
+        """The manifest on the target is used instead of the local one"""
+        self.local('/flash/lib/a.py', b'a')
+        self.sync(remote_manifest=True)
+        self.assertIn(b'/flash/lib/a.py', self.remote(wipy_ftp.MANIFEST_REMOTE))
+        # e.g. synced from another PC, without the local manifest
+        shutil.rmtree(wipy_ftp.MANIFEST_DIR)
+        self.assertEqual(self.sync(remote_manifest=True), [])
+        # without the manifest on the target, everything is transferred
+        os.remove(os.path.join(self.target.root, wipy_ftp.MANIFEST_REMOTE[1:]))
+        self.assertEqual(self.sync(remote_manifest=True), [('+', '/flash/lib/a.py')])
+
+
+if __name__ == '__main__':
+    unittest.main()
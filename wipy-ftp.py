@@ -7,28 +7,325 @@
 """\
 WiPy helper tool to access file via FTP.
 """
+import calendar
+import collections
 import configparser  # https://docs.python.org/3/library/configparser.html
 import ftplib        # https://docs.python.org/3/library/ftplib.html
 import glob
+import gzip
+import hashlib
 import io
+import json
 import logging
 import os
+import queue
+import re
 import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import posixpath
 import datetime
+import time
+import concurrent.futures
 
 INI_TEMPLATE = """\
 [FTP]
 server = 192.168.1.1
 user = micro
 pass = python
+# number of parallel FTP sessions used for transfers of multiple files
+# (the FTP server of the WiPy handles only one client at a time)
+connections = 1
+blocksize = 1024
+retries = 2
 """
 
+MANIFEST_DIR = '.wipy-manifests'
+MANIFEST_REMOTE = '/flash/manifest.json'
+BACKUP_DIR = 'backups'
+MPY_CACHE_DIR = '.mpy-cache'
+GZIP_CACHE_DIR = '.gzip-cache'
+# file types served by the web server that are worth compressing
+GZIP_EXTENSIONS = ('.html', '.htm', '.css', '.js', '.json', '.svg', '.txt', '.xml')
+
+
+# directory entry on the target, size and mtime (seconds since epoch, UTC) may be None if unknown
+RemoteStat = collections.namedtuple('RemoteStat', 'name is_dir size mtime')
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+re_list_line = re.compile(
+    r'^(?P<type>[-dl])\S*\s+\d+\s+\S+\s+\S+\s+(?P<size>\d+)\s+'
+    r'(?P<month>[A-Z][a-z]{2})\s+(?P<day>\d{1,2})\s+(?P<time>\d{1,2}:\d{2}|\d{4}) (?P<name>.+)$')
+
+
+def parse_mlsd_time(value):
+    """Convert MLSD "modify" fact (YYYYMMDDHHMMSS[.sss], UTC) to seconds since epoch"""
+    return calendar.timegm(datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S').timetuple())
+
+
+def parse_list_line(line, now=None):
+    """\
+    Parse one line of a Unix style LIST output. Returns a RemoteStat or None
+    for lines that do not look like a directory entry.
+    """
+    m = re_list_line.match(line)
+    if m is None:
+        # unknown format, name at fixed position as used by the WiPy
+        if len(line) <= 49:
+            return None
+        return RemoteStat(line[49:], line.startswith('d'), None, None)
+    if m.group('month') not in MONTHS:
+        return RemoteStat(m.group('name'), m.group('type') == 'd', int(m.group('size')), None)
+    month = MONTHS.index(m.group('month')) + 1
+    day = int(m.group('day'))
+    if ':' in m.group('time'):
+        # recent files: no year but the time, it is within the last 6 months
+        if now is None:
+            now = datetime.datetime.utcnow()
+        hour, minute = (int(x) for x in m.group('time').split(':'))
+        year = now.year if (month, day) <= (now.month, now.day) else now.year - 1
+    else:
+        year, hour, minute = int(m.group('time')), 0, 0
+    try:
+        mtime = calendar.timegm((year, month, day, hour, minute, 0))
+    except ValueError:
+        mtime = None
+    return RemoteStat(m.group('name'), m.group('type') == 'd', int(m.group('size')), mtime)
+
+
+def file_digest(filename):
+    """Calculate the SHA1 of a local file, returned as hex string"""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def safe_name(text):
+    """Turn an arbitrary string (IP, path) into something usable as filename"""
+    return re.sub(r'[^\w.-]+', '_', text).strip('_')
+
+
+class Manifest(object):
+    """\
+    Size and hash of each file that was installed on a target. It is used to
+    find out which files need to be transferred on the next sync.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.files = {}  # remote name -> {'size': ..., 'sha1': ...}
+
+    def loads(self, data):
+        self.files = json.loads(data.decode('utf-8'))['files']
+
+    def dumps(self):
+        return json.dumps({'version': 1, 'files': self.files}, indent=1, sort_keys=True).encode('utf-8')
+
+    def load(self):
+        """Read the manifest from the local file, if it exists"""
+        if self.filename is not None and os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                self.loads(f.read())
+            return True
+        return False
+
+    def save(self):
+        """Write the manifest to the local file"""
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with open(self.filename, 'wb') as f:
+            f.write(self.dumps())
+
+
+class BackupStore(object):
+    """\
+    Content addressed storage for backups. Each file is stored once, named by
+    its SHA1, in "blobs". A backup is a snapshot index per target, mapping
+    remote names to size, mtime and hash, so unchanged files are only
+    referenced again.
+    """
+    def __init__(self, root=BACKUP_DIR):
+        self.root = root
+        self.tmp = os.path.join(root, 'tmp')
+
+    def blob_path(self, sha1):
+        return os.path.join(self.root, 'blobs', sha1[:2], sha1)
+
+    def temp_path(self, target_name):
+        """\
+        Create a new, unique file for a download from a target and return
+        its name (multiple targets may be backed up in parallel).
+        """
+        directory = os.path.join(self.tmp, target_name)
+        os.makedirs(directory, exist_ok=True)
+        fd, filename = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        return filename
+
+    def add_blob(self, filename):
+        """Move a downloaded file into the store, return its hash"""
+        sha1 = file_digest(filename)
+        blob = self.blob_path(sha1)
+        if os.path.exists(blob):
+            os.remove(filename)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(filename, blob)
+        return sha1
+
+    def snapshots(self, target_name):
+        """Sorted list of snapshot names (oldest first) of a target"""
+        try:
+            names = os.listdir(os.path.join(self.root, target_name))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-5] for name in names if name.endswith('.json'))
+
+    def _snapshot_path(self, target_name, snapshot):
+        return os.path.join(self.root, target_name, '{}.json'.format(snapshot))
+
+    def load_snapshot(self, target_name, snapshot):
+        with open(self._snapshot_path(target_name, snapshot), 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))['files']
+
+    def save_snapshot(self, target_name, files):
+        snapshot = '{:%Y-%m-%d_%H_%M_%S}'.format(datetime.datetime.now())
+        if os.path.exists(self._snapshot_path(target_name, snapshot)):
+            snapshot += '_{}'.format(len(self.snapshots(target_name)))
+        filename = self._snapshot_path(target_name, snapshot)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(json.dumps({'version': 1, 'files': files}, indent=1, sort_keys=True).encode('utf-8'))
+        return snapshot
+
+    def remove_snapshot(self, target_name, snapshot):
+        os.remove(self._snapshot_path(target_name, snapshot))
+
+    def collect_garbage(self):
+        """\
+        Delete blobs that are not referenced by any snapshot of any target,
+        return their count. Other targets may be pruned at the same time, so
+        snapshots and blobs that disappear in between are skipped.
+        """
+        referenced = set()
+        for target_name in os.listdir(self.root):
+            if target_name in ('blobs', 'tmp'):
+                continue
+            for snapshot in self.snapshots(target_name):
+                try:
+                    files = self.load_snapshot(target_name, snapshot)
+                except FileNotFoundError:
+                    continue
+                referenced.update(entry['sha1'] for entry in files.values())
+        removed = 0
+        for blob in glob.glob(os.path.join(self.root, 'blobs', '*', '*')):
+            if os.path.basename(blob) not in referenced:
+                try:
+                    os.remove(blob)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+        return removed
+
+
+class MpyCompiler(object):
+    """\
+    Cross compile Python sources to .mpy files using mpy-cross. The results
+    are cached, named by the hash of compiler version, source name and
+    contents, so unchanged modules are not compiled again.
+    """
+    def __init__(self, command='mpy-cross', cache_dir=MPY_CACHE_DIR):
+        self.command = command
+        self.cache_dir = cache_dir
+        self._version = None
+
+    def available(self):
+        return shutil.which(self.command) is not None
+
+    def version(self):
+        if self._version is None:
+            self._version = subprocess.run(
+                [self.command, '--version'],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+        return self._version
+
+    def compile(self, filename, source_name):
+        """\
+        Return the name of the compiled file, source_name is used in
+        tracebacks. Raises subprocess.CalledProcessError on errors.
+        """
+        h = hashlib.sha1(self.version())
+        h.update(source_name.encode('utf-8'))
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+        output = os.path.join(self.cache_dir, '{}.mpy'.format(h.hexdigest()))
+        if not os.path.exists(output):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # unique temporary name, multiple boards may be synced in parallel
+            temp_name = '{}.{}.tmp'.format(output, threading.get_ident())
+            subprocess.run([self.command, '-s', source_name, '-o', temp_name, filename],
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+            os.replace(temp_name, output)
+        return output
+
+
+class GzipCompressor(object):
+    """\
+    Pre-compress web assets, so that web.response.FileResponse can serve the
+    *.gz files directly. The output is deterministic (no timestamp in the
+    header), so manifests do not see a change if the source is unchanged.
+    Results are cached by the hash of the contents.
+    """
+    def __init__(self, cache_dir=GZIP_CACHE_DIR, extensions=GZIP_EXTENSIONS):
+        self.cache_dir = cache_dir
+        self.extensions = extensions
+
+    def wanted(self, filename):
+        return os.path.splitext(filename)[1].lower() in self.extensions
+
+    def compress(self, filename):
+        """Return the name of the compressed file"""
+        with open(filename, 'rb') as f:
+            data = f.read()
+        output = os.path.join(self.cache_dir, '{}.gz'.format(hashlib.sha1(data).hexdigest()))
+        if not os.path.exists(output):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_name = '{}.{}.tmp'.format(output, threading.get_ident())
+            with open(temp_name, 'wb') as f:
+                with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=f, mtime=0) as z:
+                    z.write(data)
+            os.replace(temp_name, output)
+        return output
+
+
+def read_config(read_ini='wipy-ftp.ini'):
+    """Read the settings file, missing entries are taken from the defaults"""
+    config = configparser.RawConfigParser()
+    config.read_string(INI_TEMPLATE)
+    if read_ini is not None:
+        if os.path.exists(read_ini):
+            config.read(read_ini)
+        else:
+            logging.warning('"{}" not found, using defaults'.format(read_ini))
+    return config
+
+
+def fleet_boards(config):
+    """Return the names of the boards listed as [board:<name>] sections"""
+    return [section.split(':', 1)[1] for section in config.sections() if section.startswith('board:')]
+
 
 class WiPySimulator(object):
     def __init__(self, root_directory):
+        self.board = None
         self.root = os.path.abspath(root_directory)
+        self.name = safe_name('simulator_{}'.format(self.root))
         self.log = logging.getLogger('FTP')
         self.log.debug('WiPy FTP Simulator in {}'.format(self.root))
         if not os.path.exists(os.path.join(self.root, 'flash')):
@@ -48,7 +345,32 @@ class WiPySimulator(object):
         print(os.listdir(os.path.join(self.root, path)))
 
     def walk(self, root):
-        yield from os.walk(os.path.join(self.root, posixpath.relpath(root, '/')))
+        """recursively list files on target"""
+        for local_root, dirs, files in os.walk(os.path.join(self.root, posixpath.relpath(root, '/'))):
+            # report remote names, like WiPyFTP does
+            remote_root = '/' + os.path.relpath(local_root, self.root).replace(os.sep, '/')
+            yield remote_root.rstrip('/.') or '/', dirs, files
+
+    def listdir(self, path):
+        """list directory, returns a list of RemoteStat"""
+        try:
+            with os.scandir(os.path.join(self.root, posixpath.relpath(path, '/'))) as entries:
+                return [RemoteStat(entry.name, entry.is_dir(),
+                                   None if entry.is_dir() else entry.stat().st_size,
+                                   int(entry.stat().st_mtime))
+                        for entry in entries]
+        except OSError as e:
+            self.log.error('invalid path: {} ({})'.format(path, e))
+            return []
+
+    def stat(self, filename):
+        """return RemoteStat of a file or directory or None if it does not exist"""
+        try:
+            st = os.stat(os.path.join(self.root, os.path.relpath(filename, '/')))
+        except OSError:
+            return None
+        is_dir = os.path.isdir(os.path.join(self.root, os.path.relpath(filename, '/')))
+        return RemoteStat(posixpath.basename(filename), is_dir, None if is_dir else st.st_size, int(st.st_mtime))
 
     def makedirs(self, dirname):
         """Recursively create directories, if not yet existing"""
@@ -60,33 +382,84 @@ class WiPySimulator(object):
         self.log.info('put {}'.format(filename))
         with open(os.path.join(self.root, os.path.relpath(filename, '/')), 'wb') as dst:
             shutil.copyfileobj(fileobj, dst)
+        return True
 
     def get(self, filename, fileobj):
         """receive binary file"""
         self.log.info('get {}'.format(filename))
-        with open(os.path.join(self.root, os.path.relpath(filename, '/')), 'rb') as src:
-            shutil.copyfileobj(src, fileobj)
+        try:
+            with open(os.path.join(self.root, os.path.relpath(filename, '/')), 'rb') as src:
+                shutil.copyfileobj(src, fileobj)
+        except OSError as e:
+            self.log.error('invalid path: {} ({})'.format(filename, e))
+            return False
+        return True
+
+    def put_files(self, jobs):
+        """send list of (remote name, local filename), return names of transferred files"""
+        done = []
+        for filename, local_name in jobs:
+            with open(local_name, 'rb') as src:
+                if self.put(filename, src):
+                    done.append(filename)
+        return done
+
+    def get_files(self, jobs):
+        """receive list of (remote name, local filename), return names of transferred files"""
+        done = []
+        for filename, local_name in jobs:
+            with open(local_name, 'wb') as dst:
+                if self.get(filename, dst):
+                    done.append(filename)
+        return done
+
+    def remove(self, filename):
+        """delete file"""
+        self.log.info('remove {}'.format(filename))
+        try:
+            os.remove(os.path.join(self.root, os.path.relpath(filename, '/')))
+        except OSError as e:
+            self.log.error('invalid path: {} ({})'.format(filename, e))
+            return False
+        return True
 
 
 class WiPyFTP(object):
-    def __init__(self, read_ini='wipy-ftp.ini'):
+    def __init__(self, read_ini='wipy-ftp.ini', board=None, config=None):
+        """\
+        Settings are taken from the [FTP] section of the ini file. When a
+        board name is given, the entries of its [board:<name>] section
+        override these.
+        """
         self.ftp = None
-        self.log = logging.getLogger('FTP')
-        self.config = configparser.RawConfigParser()
-        self.config.read_string(INI_TEMPLATE)
-        if read_ini is not None:
-            if os.path.exists(read_ini):
-                self.config.read(read_ini)
-            else:
-                logging.warning('"{}" not found, using defaults'.format(read_ini))
-        self.log.debug('WiPy IP: {}'.format(self.config['FTP']['server']))
-        self.log.debug('FTP user: {}'.format(self.config['FTP']['user']))
-        self.log.debug('FTP pass: {}'.format(self.config['FTP']['pass']))
+        self.board = board
+        self.config = config if config is not None else read_config(read_ini)
+        self.settings = dict(self.config['FTP'])
+        if board is None:
+            self.log = logging.getLogger('FTP')
+        else:
+            self.log = logging.getLogger('FTP.{}'.format(board))
+            self.settings.update(self.config['board:{}'.format(board)])
+        self.name = safe_name(self.settings['server'])
+        self.log.debug('WiPy IP: {}'.format(self.settings['server']))
+        self.log.debug('FTP user: {}'.format(self.settings['user']))
+        self.log.debug('FTP pass: {}'.format(self.settings['pass']))
+        self.connections = max(1, int(self.settings['connections']))
+        self.blocksize = int(self.settings['blocksize'])
+        self.retries = int(self.settings['retries'])
+        self._listings = {}     # directory listings cached for this session
+        self._use_mlsd = True   # set to False if the server does not support MLSD
+
+    def _connect(self):
+        ftp = ftplib.FTP(self.settings['server'])
+        ftp.login(self.settings['user'], self.settings['pass'])
+        return ftp
 
     def __enter__(self):
         self.log.debug('Connecting...')
-        self.ftp = ftplib.FTP(self.config['FTP']['server'])
-        self.ftp.login(self.config['FTP']['user'], self.config['FTP']['pass'])
+        self._listings = {}
+        self._use_mlsd = True
+        self.ftp = self._connect()
         self.log.debug('Connection OK')
         return self
 
@@ -107,31 +480,72 @@ class WiPyFTP(object):
         except ftplib.all_errors as e:
             self.log.error('FTP error: {}'.format(e))
 
+    def _list(self, path):
+        if self._use_mlsd:
+            try:
+                return [RemoteStat(name, facts.get('type') == 'dir',
+                                   int(facts['size']) if 'size' in facts else None,
+                                   parse_mlsd_time(facts['modify']) if 'modify' in facts else None)
+                        for name, facts in self.ftp.mlsd(path, ['type', 'size', 'modify'])
+                        if facts.get('type') in ('dir', 'file')]
+            except ftplib.error_perm as e:
+                if not str(e).startswith(('500', '502')):
+                    raise
+                self.log.debug('MLSD not supported, using LIST ({})'.format(e))
+                self._use_mlsd = False
+        # the WiPy ignores arguments of LIST, it always lists the current directory
+        lines = []
+        self.ftp.cwd(path)
+        self.ftp.retrlines('LIST', lines.append)
+        entries = (parse_list_line(line) for line in lines)
+        return [entry for entry in entries if entry is not None and entry.name not in ('.', '..')]
+
+    def listdir(self, path):
+        """list directory, returns a list of RemoteStat (cached for the session)"""
+        path = posixpath.normpath(path)
+        if path not in self._listings:
+            self.log.debug('list {}'.format(path))
+            try:
+                self._listings[path] = self._list(path)
+            except ftplib.error_perm as e:
+                self.log.error('invalid path: {} ({})'.format(path, e))
+                return []
+            except ftplib.all_errors as e:
+                self.log.error('FTP error: {}'.format(e))
+                return []
+        return self._listings[path]
+
+    def _invalidate(self, filename):
+        self._listings.pop(posixpath.dirname(posixpath.normpath(filename)), None)
+
+    def stat(self, filename):
+        """return RemoteStat of a file or directory or None if it does not exist"""
+        filename = posixpath.normpath(filename)
+        if filename == '/':
+            return RemoteStat('/', True, None, None)
+        name = posixpath.basename(filename)
+        for entry in self.listdir(posixpath.dirname(filename)):
+            if entry.name == name:
+                return entry
+        return None
+
     def walk(self, root):
         """recursively list files on target"""
         self.log.debug('walk {}'.format(root))
-        try:
-            self.ftp.cwd(root)
-            lines = []
-            self.ftp.retrlines('LIST', lines.append)
-            items = [(x.startswith('d'), x[49:]) for x in lines]
-            dirs = [name for is_dir, name in items if is_dir]
-            files = [name for is_dir, name in items if not is_dir]
-            yield root, dirs, files
-            for r in dirs:
-                if root == '/':
-                    yield from self.walk('/{}'.format(r))
-                else:
-                    yield from self.walk('{}/{}'.format(root, r))
-        except ftplib.error_perm as e:
-            self.log.error('invalid path: {} ({})'.format(path, e))
-        except ftplib.all_errors as e:
-            self.log.error('FTP error: {}'.format(e))
-
+        entries = self.listdir(root)
+        dirs = [entry.name for entry in entries if entry.is_dir]
+        files = [entry.name for entry in entries if not entry.is_dir]
+        yield root, dirs, files
+        for name in dirs:
+            yield from self.walk(posixpath.join(root, name))
 
     def makedirs(self, dirname):
         """Recursively create directories, if not yet existing"""
+        stat = self.stat(dirname)
+        if stat is not None and stat.is_dir:
+            return
         self.log.info('makedirs {}'.format(dirname))
+        self._invalidate(dirname)
         try:
             self.ftp.cwd('/')
         except ftplib.error_perm as e:
@@ -145,6 +559,7 @@ class WiPyFTP(object):
                 self.log.info('creating directory: {} ({})'.format(dirname, e))
                 try:
                     self.ftp.mkd(directory)
+                    self._invalidate(posixpath.join(self.ftp.pwd(), directory))
                     self.ftp.cwd(directory)
                 except ftplib.error_perm as e:
                     self.log.error('error while creating directory: {} ({})'.format(dirname, e))
@@ -156,21 +571,121 @@ class WiPyFTP(object):
         """send binary file"""
         try:
             self.log.info('put {}'.format(filename))
-            self.ftp.storbinary("STOR " + filename, fileobj, 1024)
+            self._invalidate(filename)
+            self.ftp.storbinary("STOR " + filename, fileobj, self.blocksize)
         except ftplib.error_perm as e:
             self.log.error('invalid path: {} ({})'.format(filename, e))
         except ftplib.all_errors as e:
             self.log.error('FTP error: {}'.format(e))
+        else:
+            return True
+        return False
 
     def get(self, filename, fileobj):
         """receive binary file"""
         try:
             self.log.info('get {}'.format(filename))
-            self.ftp.retrbinary("RETR " + filename, fileobj.write, 1024)
+            self.ftp.retrbinary("RETR " + filename, fileobj.write, self.blocksize)
+        except ftplib.error_perm as e:
+            self.log.error('invalid path: {} ({})'.format(filename, e))
+        except ftplib.all_errors as e:
+            self.log.error('FTP error: {}'.format(e))
+        else:
+            return True
+        return False
+
+    def _put_file(self, ftp, filename, local_name):
+        self._invalidate(filename)
+        with open(local_name, 'rb') as src:
+            ftp.storbinary("STOR " + filename, src, self.blocksize)
+
+    def _get_file(self, ftp, filename, local_name):
+        # download to a temporary name, so that failed transfers leave no partial files
+        part_name = local_name + '.part'
+        try:
+            with open(part_name, 'wb') as dst:
+                ftp.retrbinary("RETR " + filename, dst.write, self.blocksize)
+        except Exception:
+            os.remove(part_name)
+            raise
+        os.replace(part_name, local_name)
+
+    def _transfer(self, jobs, verb, function):
+        """\
+        Work through a list of (remote name, local filename) jobs using up to
+        "connections" FTP sessions in parallel. Each file is retried on
+        temporary errors, using a new session. Returns the names of the files
+        that were transferred successfully.
+        """
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        done = []
+
+        def worker(ftp):
+            while True:
+                try:
+                    filename, local_name = pending.get_nowait()
+                except queue.Empty:
+                    return ftp
+                for attempt in range(self.retries + 1):
+                    try:
+                        if ftp is None:
+                            ftp = self._connect()
+                        self.log.info('{} {}'.format(verb, filename))
+                        function(ftp, filename, local_name)
+                    except ftplib.error_perm as e:
+                        self.log.error('invalid path: {} ({})'.format(filename, e))
+                        break
+                    except ftplib.all_errors as e:
+                        self.log.warning('FTP error: {} ({}), attempt {} of {}'.format(
+                            filename, e, attempt + 1, self.retries + 1))
+                        if ftp is not None:
+                            ftp.close()
+                            ftp = None
+                    else:
+                        done.append(filename)
+                        break
+
+        def run_worker():
+            ftp = worker(None)
+            if ftp is not None:
+                ftp.quit()
+
+        threads = []
+        for n in range(min(self.connections, len(jobs)) - 1):
+            t = threading.Thread(target=run_worker, name='FTP-{}'.format(n + 1))
+            t.start()
+            threads.append(t)
+        # the main session is used as one of the workers
+        self.ftp = worker(self.ftp)
+        for t in threads:
+            t.join()
+        if self.ftp is None:
+            self.ftp = self._connect()
+        return done
+
+    def put_files(self, jobs):
+        """send list of (remote name, local filename), return names of transferred files"""
+        return self._transfer(jobs, 'put', self._put_file)
+
+    def get_files(self, jobs):
+        """receive list of (remote name, local filename), return names of transferred files"""
+        return self._transfer(jobs, 'get', self._get_file)
+
+    def remove(self, filename):
+        """delete file"""
+        try:
+            self.log.info('remove {}'.format(filename))
+            self._invalidate(filename)
+            self.ftp.delete(filename)
         except ftplib.error_perm as e:
             self.log.error('invalid path: {} ({})'.format(filename, e))
         except ftplib.all_errors as e:
             self.log.error('FTP error: {}'.format(e))
+        else:
+            return True
+        return False
 
 
 WLANCONFIG_TEMPLATE = """\
@@ -183,10 +698,32 @@ import ulog
 ulog.add_remote({ip!r}, {port})
 """
 
+def ask_wlan():
+    ssid = input('Enter SSID: ')
+    password = input('Enter passphrase: ')
+    return ssid, password
+
+
+def ask_ulog():
+    ip = input('Enter IP: ')
+    port = input('UDP port [514]: ')
+    if not port:
+        port = '514'
+    return ip, int(port)
+
+
 class WiPyActions():
 
-    def __init__(self, target):
+    def __init__(self, target, dry_run=False, force=False, remote_manifest=False, backup_dir=BACKUP_DIR,
+                 compiler=None, compressor=None):
         self.target = target
+        self.compiler = compiler
+        self.compressor = compressor
+        self.log = target.log
+        self.dry_run = dry_run
+        self.force = force
+        self.remote_manifest = remote_manifest
+        self.backup_store = BackupStore(backup_dir)
 
     def __enter__(self):
         self.target.__enter__()
@@ -206,50 +743,428 @@ class WiPyActions():
     def get(self, filename, fileobj):
         self.target.get(filename, fileobj)
 
+    def load_manifest(self):
+        """\
+        Get the manifest for the current target. With remote_manifest, the
+        copy on the target is used (a missing one means nothing is known about
+        the target), otherwise the local file.
+        """
+        manifest = Manifest(os.path.join(MANIFEST_DIR, '{}.json'.format(self.target.name)))
+        if self.remote_manifest:
+            data = io.BytesIO()
+            if self.target.get(MANIFEST_REMOTE, data):
+                try:
+                    manifest.loads(data.getvalue())
+                except (ValueError, KeyError) as e:
+                    self.log.warning('ignoring invalid {} ({})'.format(MANIFEST_REMOTE, e))
+            else:
+                self.log.info('no manifest on target, all files are transferred')
+        else:
+            manifest.load()
+        return manifest
+
+    def save_manifest(self, manifest):
+        manifest.save()
+        if self.remote_manifest:
+            self.target.put(MANIFEST_REMOTE, io.BytesIO(manifest.dumps()))
+
+    def sync(self, files, scope, recursive=True):
+        """\
+        Upload files (mapping remote name -> local filename) that are not yet
+        on the target according to the manifest and remove files below scope
+        that were installed earlier but are no longer present locally.
+        Returns the list of (action, remote name) changes.
+        """
+        manifest = self.load_manifest()
+        uploads = []
+        for remote_name, local_name in sorted(files.items()):
+            entry = {'size': os.path.getsize(local_name), 'sha1': file_digest(local_name)}
+            previous = manifest.files.get(remote_name)
+            if previous is None or self.force:
+                uploads.append(('+', remote_name, local_name, entry))
+            elif previous != entry:
+                uploads.append(('M', remote_name, local_name, entry))
+            else:
+                # the manifest says it is there, check the listing of the target
+                stat = self.target.stat(remote_name)
+                if stat is None:
+                    uploads.append(('+', remote_name, local_name, entry))
+                elif stat.size is not None and stat.size != entry['size']:
+                    uploads.append(('M', remote_name, local_name, entry))
+        removals = []
+        for remote_name in sorted(manifest.files):
+            if remote_name in files:
+                continue
+            if recursive:
+                in_scope = remote_name.startswith(scope + '/')
+            else:
+                in_scope = posixpath.dirname(remote_name) == scope
+            if in_scope:
+                removals.append(remote_name)
+
+        changes = [(action, remote_name) for action, remote_name, _, _ in uploads]
+        changes.extend(('-', remote_name) for remote_name in removals)
+        if self.dry_run:
+            for action, remote_name in changes:
+                print('{} {}'.format(action, remote_name))
+            self.log.info('dry run: {} to upload, {} to remove, {} unchanged'.format(
+                len(uploads), len(removals), len(files) - len(uploads)))
+            return changes
+
+        for directory in sorted(set(posixpath.dirname(remote_name) for _, remote_name, _, _ in uploads)):
+            self.target.makedirs(directory)
+        done = set(self.target.put_files([(remote_name, local_name) for _, remote_name, local_name, _ in uploads]))
+        for action, remote_name, local_name, entry in uploads:
+            if remote_name in done:
+                manifest.files[remote_name] = entry
+        removed = 0
+        for remote_name in removals:
+            if self.target.remove(remote_name):
+                del manifest.files[remote_name]
+                removed += 1
+        self.log.info('{} uploaded, {} removed, {} unchanged'.format(
+            len(done), removed, len(files) - len(uploads)))
+        if len(done) != len(uploads) or removed != len(removals):
+            self.log.error('{} files failed'.format(len(uploads) - len(done) + len(removals) - removed))
+        self.save_manifest(manifest)
+        return changes
+
     def install_lib(self):
         """recursively copy /flash/lib"""
         base_path = 'device/flash/lib'
-        for root, dirs, files in os.walk(base_path):
+        files = {}
+        for root, dirs, filenames in os.walk(base_path):
             if '__pycache__' in dirs:
                 dirs.remove('__pycache__')
-            self.target.makedirs('/{}'.format(os.path.relpath(root, 'device')))
-            for filename in files:
+            for filename in filenames:
                 remote_name = os.path.relpath(os.path.join(root, filename), 'device')
-                with open(os.path.join(root, filename), 'rb') as src:
-                    remote_name = remote_name.replace('\\', '/')
-                    self.target.put('/{}'.format(remote_name), src)
+                files['/{}'.format(remote_name.replace('\\', '/'))] = os.path.join(root, filename)
+        if self.compiler is not None:
+            files = self.compile_files(files, '/flash/lib')
+            if files is None:
+                return []
+        if self.compressor is not None:
+            files = self.compress_files(files)
+        return self.sync(files, '/flash/lib')
+
+    def compile_files(self, files, base):
+        """\
+        Replace *.py files (mapping remote name -> local filename) with
+        compiled *.mpy files. Files that fail to compile are kept as source.
+        Returns None if the compiler is not available.
+        """
+        if not self.compiler.available():
+            self.log.error('"{}" not found, can not compile'.format(self.compiler.command))
+            return None
+        compiled = {}
+        for remote_name, local_name in files.items():
+            if remote_name.endswith('.py'):
+                try:
+                    compiled[remote_name[:-3] + '.mpy'] = self.compiler.compile(
+                        local_name, posixpath.relpath(remote_name, base))
+                    continue
+                except subprocess.CalledProcessError as e:
+                    self.log.error('compiling {} failed, using source:\n{}'.format(
+                        local_name, e.output.decode('utf-8', 'replace')))
+            compiled[remote_name] = local_name
+        return compiled
+
+    def compress_files(self, files):
+        """\
+        Replace web assets (mapping remote name -> local filename) with
+        gzip compressed *.gz files, if that makes them smaller.
+        """
+        compressed = {}
+        for remote_name, local_name in files.items():
+            if self.compressor.wanted(remote_name):
+                gz_name = self.compressor.compress(local_name)
+                if os.path.getsize(gz_name) < os.path.getsize(local_name):
+                    compressed[remote_name + '.gz'] = gz_name
+                    continue
+            compressed[remote_name] = local_name
+        return compressed
 
     def install_top(self):
         """copy *.py in /flash"""
+        files = {}
         for filename in glob.glob('device/flash/*.py'):
-            with open(filename, 'rb') as src:
-                self.target.put('/flash/{}'.format(os.path.basename(filename)), src)
+            files['/flash/{}'.format(os.path.basename(filename))] = filename
+        if self.compressor is not None:
+            files = self.compress_files(files)
+        return self.sync(files, '/flash', recursive=False)
 
-    def config_wlan(self):
-        ssid = input('Enter SSID: ')
-        password = input('Enter passphrase: ')
+    def config_wlan(self, ssid=None, password=None):
+        if ssid is None:
+            ssid, password = ask_wlan()
         self.target.put('/flash/wlanconfig.py',
                         io.BytesIO(WLANCONFIG_TEMPLATE.format(ssid=ssid, password=password).encode('utf-8')))
 
-    def config_ulog(self):
-        ip = input('Enter IP: ')
-        port = input('UDP port [514]: ')
-        if not port:
-            port = '514'
+    def config_ulog(self, ip=None, port=None):
+        if ip is None:
+            ip, port = ask_ulog()
         self.target.put('/flash/ulogconfig.py',
                         io.BytesIO(ULOG_CONFIG_TEMPLATE.format(ip=ip, port=int(port)).encode('utf-8')))
 
+    def config_boottrace(self, enable):
+        """enable or disable boot profiling (see boottrace.py)"""
+        if enable:
+            self.target.put('/flash/boottrace', io.BytesIO(b''))
+        elif self.target.stat('/flash/boottrace') is not None:
+            self.target.remove('/flash/boottrace')
+
     def backup(self):
-        """Download all data from /flash"""
-        backup_dir = 'backup_{:%Y-%m-%d_%H_%M_%S}'.format(datetime.datetime.now())
-        logging.info('backing up /flash into {}'.format(backup_dir))
-        for root, dirs, files in self.target.walk('/flash'):
-            local_root = os.path.join(backup_dir, posixpath.relpath(root, '/'))
-            if not os.path.exists(local_root):
-                os.makedirs(local_root)
-            for name in files:
-                with open(os.path.join(local_root, name), 'wb') as dst:
-                    self.target.get(posixpath.join(root, name), dst)
+        """\
+        Download all data from /flash into the backup store. Files with the
+        same size and mtime as in the last snapshot are not downloaded again.
+        """
+        store = self.backup_store
+        snapshots = store.snapshots(self.target.name)
+        if snapshots:
+            previous = store.load_snapshot(self.target.name, snapshots[-1])
+        else:
+            previous = {}
+        self.log.info('backing up /flash into {}'.format(os.path.join(store.root, self.target.name)))
+        files = {}
+        jobs = []
+        stats = {}
+        for root, dirs, names in self.target.walk('/flash'):
+            for name in names:
+                remote_name = posixpath.join(root, name)
+                stat = self.target.stat(remote_name)
+                entry = previous.get(remote_name)
+                if (stat is not None and stat.size is not None and stat.mtime is not None
+                        and entry is not None
+                        and (entry['size'], entry['mtime']) == (stat.size, stat.mtime)
+                        and os.path.exists(store.blob_path(entry['sha1']))):
+                    files[remote_name] = entry
+                else:
+                    stats[remote_name] = stat
+                    jobs.append((remote_name, store.temp_path(self.target.name)))
+        try:
+            done = set(self.target.get_files(jobs))
+            for remote_name, local_name in jobs:
+                if remote_name in done:
+                    size = os.path.getsize(local_name)
+                    sha1 = store.add_blob(local_name)
+                    stat = stats[remote_name]
+                    files[remote_name] = {'size': size, 'mtime': stat.mtime if stat is not None else None, 'sha1': sha1}
+        finally:
+            # files that were not moved into the store
+            for remote_name, local_name in jobs:
+                for name in (local_name, local_name + '.part'):
+                    if os.path.exists(name):
+                        os.remove(name)
+        snapshot = store.save_snapshot(self.target.name, files)
+        self.log.info('snapshot {}: {} files, {} downloaded, {} unchanged'.format(
+            snapshot, len(files), len(done), len(files) - len(done)))
+        if len(done) != len(jobs):
+            self.log.error('{} files could not be backed up'.format(len(jobs) - len(done)))
+        return snapshot
+
+    def restore(self, snapshot=None):
+        """\
+        Upload all files of a snapshot ("latest" for the newest one). Without
+        snapshot name, the list of available snapshots is printed.
+        """
+        store = self.backup_store
+        snapshots = store.snapshots(self.target.name)
+        if snapshot is None:
+            for name in snapshots:
+                print(name)
+            return
+        if snapshot == 'latest' and snapshots:
+            snapshot = snapshots[-1]
+        if snapshot not in snapshots:
+            self.log.error('no snapshot {} for {}'.format(snapshot, self.target.name))
+            return
+        files = store.load_snapshot(self.target.name, snapshot)
+        self.log.info('restoring snapshot {} ({} files)'.format(snapshot, len(files)))
+        for directory in sorted(set(posixpath.dirname(remote_name) for remote_name in files)):
+            self.target.makedirs(directory)
+        done = self.target.put_files([(remote_name, store.blob_path(entry['sha1']))
+                                      for remote_name, entry in sorted(files.items())])
+        # files installed by sync may have changed, keep the manifest correct
+        manifest = self.load_manifest()
+        for remote_name in done:
+            if remote_name in manifest.files:
+                manifest.files[remote_name] = {'size': files[remote_name]['size'], 'sha1': files[remote_name]['sha1']}
+        self.save_manifest(manifest)
+        if len(done) != len(files):
+            self.log.error('{} files could not be restored'.format(len(files) - len(done)))
+
+    def prune(self, keep):
+        """Remove all but the newest "keep" snapshots and delete unreferenced data"""
+        store = self.backup_store
+        snapshots = store.snapshots(self.target.name)
+        for snapshot in snapshots[:max(0, len(snapshots) - keep)]:
+            self.log.info('removing snapshot {}'.format(snapshot))
+            store.remove_snapshot(self.target.name, snapshot)
+        self.log.info('{} unreferenced files removed from {}'.format(store.collect_garbage(), store.root))
+
+
+HELP_TEXT = """\
+ACTIONS are:
+- "write-ini" create ``wipy-ftp.ini`` with default settings
+- "install"  copy boot.py, main.py and /lib from the PC to the WiPy
+- "sync-lib" copies only /lib (changed files only, see --dry-run, --force, --compile, --gzip)
+- "sync-top" copies only boot.py, main.py (changed files only)
+- "config-wlan" ask for SSID/Password and write wlanconfig.py on WiPy
+- "config-ulog" ask for IP/port and write ulogconfig.py on WiPy
+- "config-boottrace" enable/disable sending boot profiling data via ulog
+- "ls" with optional remote path argument: list files
+- "cp" with local source and remote destination: uploads binary file
+- "cat" with remote filename: show file contents
+- "backup" download everything in /flash (changed files only)
+- "restore" with snapshot name or "latest": upload a backup, lists backups if none given
+- "prune" with --keep N: remove all but the newest N backups
+- "fwupgrade"  write mcuimg.bin file to WiPy for firmware upgrade
+- "interact"  Python REPL with a connection to the WiPy
+- "help"  this text
+
+Actions supported with --fleet: install, sync-lib, sync-top, config-wlan,
+config-ulog, config-boottrace, cp, backup, prune, fwupgrade
+"""
+
+ACTIONS = ('cp', 'cat', 'ls', 'sync-lib', 'sync-top', 'install', 'config-wlan',
+           'config-ulog', 'config-boottrace', 'fwupgrade', 'backup', 'restore', 'prune', 'interact')
+FLEET_ACTIONS = ('cp', 'sync-lib', 'sync-top', 'install', 'config-wlan',
+                 'config-ulog', 'config-boottrace', 'fwupgrade', 'backup', 'prune')
+
+
+def ask_questions(action):
+    """\
+    Interactive input is requested before connecting, so that the answers can
+    be used for multiple boards.
+    """
+    answers = {}
+    if action == 'install':
+        if input('Connect to an access point? [Y/n]: ').upper() in ('', 'Y'):
+            answers['wlan'] = ask_wlan()
+    elif action == 'config-wlan':
+        print('Configure the WiPy to connect to an access point')
+        answers['wlan'] = ask_wlan()
+    elif action == 'config-ulog':
+        print('Configure the WiPy to send ulog (syslog compatible) messages to following IP address')
+        answers['ulog'] = ask_ulog()
+    elif action == 'config-boottrace':
+        print('Boot profiling data is sent via ulog, see "logviewer.py --boot-report"')
+        answers['boottrace'] = input('Enable boot profiling? [y/N]: ').upper() == 'Y'
+    return answers
+
+
+def run_action(wipy, args, answers):
+    """Execute the action given on the command line on a connected target"""
+    if args.action == 'cp':
+        with open(args.path,'rb') as src:
+            wipy.put(args.destination, src)
+    elif args.action == 'cat':
+        wipy.get(args.path, sys.stdout.buffer)
+    elif args.action == 'ls':
+        wipy.ls(args.path)
+    elif args.action == 'sync-lib':
+        wipy.install_lib()
+    elif args.action == 'sync-top':
+        wipy.install_top()
+    elif args.action == 'install':
+        wipy.backup()
+        wipy.install_top()
+        wipy.install_lib()
+        if 'wlan' in answers:
+            wipy.config_wlan(*answers['wlan'])
+    elif args.action == 'config-wlan':
+        wipy.config_wlan(*answers['wlan'])
+    elif args.action == 'config-ulog':
+        wipy.config_ulog(*answers['ulog'])
+    elif args.action == 'config-boottrace':
+        wipy.config_boottrace(answers['boottrace'])
+    elif args.action == 'fwupgrade':
+        wipy.log.info('upload /flash/sys/mcuimg.bin')
+        with open('mcuimg.bin', 'rb') as src:
+            wipy.put('/flash/sys/mcuimg.bin', src)
+        wipy.log.info('press reset button on WiPy to complete upgrade')
+    elif args.action == 'backup':
+        wipy.backup()
+    elif args.action == 'restore':
+        wipy.restore(args.path)
+    elif args.action == 'prune':
+        wipy.prune(args.keep)
+    elif args.action == 'interact':
+        # local REPL loop with established FTP connection for development
+        import code
+        try:
+            import rlcompleter
+            import readline
+        except ImportError as e:
+            logging.warning('readline support failed: {}'.format(e))
+        else:
+            readline.set_completer(rlcompleter.Completer(locals()).complete)
+            readline.parse_and_bind("tab: complete")
+        code.interact(local=locals())
+
+
+class ErrorCounter(logging.Handler):
+    """Count the error messages logged for one board"""
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def run_fleet(args, answers):
+    """\
+    Run the action on all boards of the inventory (or the ones selected with
+    --boards), using a pool of worker threads. Returns the number
+    of boards that failed.
+    """
+    config = read_config(None if args.defaults else args.ini)
+    boards = fleet_boards(config)
+    if args.boards:
+        selected = args.boards.split(',')
+        unknown = set(selected) - set(boards)
+        if unknown:
+            logging.error('unknown boards: {}'.format(', '.join(sorted(unknown))))
+            return len(unknown)
+        boards = selected
+    if not boards:
+        logging.error('no [board:<name>] sections found in "{}"'.format(args.ini))
+        return 1
+
+    compiler = MpyCompiler(args.mpy_cross) if args.compile else None
+    compressor = GzipCompressor() if args.gzip else None
+
+    def run_board(board):
+        t_start = time.time()
+        target = WiPyFTP(board=board, config=config)
+        errors = ErrorCounter()
+        target.log.addHandler(errors)
+        try:
+            with WiPyActions(target, dry_run=args.dry_run, force=args.force,
+                             remote_manifest=args.remote_manifest, backup_dir=args.backup_dir,
+                             compiler=compiler, compressor=compressor) as wipy:
+                run_action(wipy, args, answers)
+        except Exception as e:
+            target.log.error('{}: {}'.format(type(e).__name__, e))
+        finally:
+            target.log.removeHandler(errors)
+        if errors.count:
+            result = 'FAILED ({} errors)'.format(errors.count)
+        else:
+            result = 'OK'
+        target.log.info('finished: {}'.format(result))
+        return board, target.settings['server'], result, time.time() - t_start
+
+    logging.info('running "{}" on {} boards, {} at a time'.format(args.action, len(boards), args.jobs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(run_board, boards))
+
+    width = max(len(board) for board in boards)
+    print()
+    print('{:<{w}}  {:<15}  {:>7}  {}'.format('board', 'server', 'time', 'result', w=width))
+    for board, server, result, duration in results:
+        print('{:<{w}}  {:<15}  {:>6.1f}s  {}'.format(board, server, duration, result, w=width))
+    return sum(1 for _, _, result, _ in results if result != 'OK')
 
 
 def main():
@@ -270,6 +1185,17 @@ router.
     parser.add_argument('--defaults', action='store_true', help='do not read ini file, use default settings')
     parser.add_argument('--ini', help='alternate name for settings file (default: %(default)s)', default='wipy-ftp.ini')
     parser.add_argument('--simulate', metavar='DIR', help='do not access WiPy, put files in given directory instead')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='sync: only show what would be transferred or removed')
+    parser.add_argument('--force', action='store_true', help='sync: upload all files, even if unchanged')
+    parser.add_argument('--remote-manifest', action='store_true', help='sync: keep the manifest in {} on the target'.format(MANIFEST_REMOTE))
+    parser.add_argument('--compile', action='store_true', help='sync-lib: upload modules compiled to .mpy instead of source')
+    parser.add_argument('--mpy-cross', default='mpy-cross', metavar='CMD', help='cross compiler used by --compile (default: %(default)s)')
+    parser.add_argument('--gzip', action='store_true', help='sync: upload web assets (html, css, js, ...) gzip compressed as *.gz')
+    parser.add_argument('--backup-dir', default=BACKUP_DIR, metavar='DIR', help='location of the backup store (default: %(default)s)')
+    parser.add_argument('--keep', type=int, metavar='N', help='prune: number of backups to keep')
+    parser.add_argument('--fleet', action='store_true', help='run action on all boards listed in the ini file')
+    parser.add_argument('--boards', metavar='NAMES', help='with --fleet: comma separated list of boards to use instead of all')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of boards handled in parallel with --fleet (default: %(default)s)')
     # parser.add_argument('--noexp', action='store_true', help='skip steps involving the expansion board and SD storage')
 
     args = parser.parse_args()
@@ -282,80 +1208,33 @@ router.
         logging.info('"{}" written'.format(args.ini))
         sys.exit(0)
 
+    if args.action not in ACTIONS:
+        sys.stdout.write(HELP_TEXT)
+        sys.exit(0)
+
+    if args.action == 'prune' and args.keep is None:
+        parser.error('prune needs --keep N')
+
+    if args.fleet:
+        if args.action not in FLEET_ACTIONS:
+            parser.error('action "{}" is not supported with --fleet'.format(args.action))
+        if args.simulate:
+            parser.error('--fleet and --simulate can not be combined')
+        answers = ask_questions(args.action)
+        failed = run_fleet(args, answers)
+        sys.exit(1 if failed else 0)
+
+    answers = ask_questions(args.action)
     if args.simulate:
         logging.info('using simulator')
         target = WiPySimulator(args.simulate)
     else:
         logging.info('using ftp')
         target = WiPyFTP(None if args.defaults else args.ini)
-
-    if args.action == 'cp':
-        with WiPyActions(target) as wipy:
-            with open(args.path,'rb') as src:
-                wipy.put(args.destination, src)
-    elif args.action == 'cat':
-        with WiPyActions(target) as wipy:
-            wipy.get(args.path, sys.stdout.buffer)
-    elif args.action == 'ls':
-        with WiPyActions(target) as wipy:
-            wipy.ls(args.path)
-    elif args.action == 'sync-lib':
-        with WiPyActions(target) as wipy:
-            wipy.install_lib()
-    elif args.action == 'sync-top':
-        with WiPyActions(target) as wipy:
-            wipy.install_top()
-    elif args.action == 'install':
-        with WiPyActions(target) as wipy:
-            wipy.backup()
-            wipy.install_top()
-            wipy.install_lib()
-            if input('Connect to an access point? [Y/n]: ').upper() in ('', 'Y'):
-                wipy.config_wlan()
-    elif args.action == 'config-wlan':
-        with WiPyActions(target) as wipy:
-            print('Configure the WiPy to connect to an access point')
-            wipy.config_wlan()
-    elif args.action == 'config-ulog':
-        with WiPyActions(target) as wipy:
-            print('Configure the WiPy to send ulog (syslog compatible) messages to following IP address')
-            wipy.config_ulog()
-    elif args.action == 'fwupgrade':
-        with WiPyActions(target) as wipy:
-            print('upload /flash/sys/mcuimg.bin')
-            wipy.put('/flash/sys/mcuimg.bin', open('mcuimg.bin', 'rb'))
-            print('press reset button on WiPy to complete upgrade')
-    elif args.action == 'backup':
-        with WiPyActions(target) as wipy:
-            wipy.backup()
-    elif args.action == 'interact':
-        # local REPL loop with established FTP connection for development
-        with WiPyActions(target) as wipy:
-            import code
-            try:
-                import rlcompleter
-                import readline
-            except ImportError as e:
-                logging.warning('readline support failed: {}'.format(e))
-            else:
-                readline.set_completer(rlcompleter.Completer(locals()).complete)
-                readline.parse_and_bind("tab: complete")
-            code.interact(local=locals())
-    else:
-        sys.stdout.write("""\
-ACTIONS are:
-- "write-ini" create ``wipy-ftp.ini`` with default settings
-- "install"  copy boot.py, main.py and /lib from the PC to the WiPy
-- "sync-lib" copies only /lib
-- "sync-top" copies only boot.py, main.py
-- "config-wlan" ask for SSID/Password and write wlanconfig.py on WiPy
-- "ls" with optional remote path argument: list files
-- "cp" with local source and remote destination: uploads binary file
-- "cat" with remote filename: show file contents
-- "backup" download everything in /flash
-- "fwupgrade"  write mcuimg.bin file to WiPy for firmware upgrade
-- "help"  this text
-""")
+    with WiPyActions(target, dry_run=args.dry_run, force=args.force, remote_manifest=args.remote_manifest,
+                     backup_dir=args.backup_dir, compiler=MpyCompiler(args.mpy_cross) if args.compile else None,
+                     compressor=GzipCompressor() if args.gzip else None) as wipy:
+        run_action(wipy, args, answers)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 if __name__ == '__main__':